@@ -0,0 +1,122 @@
+""" Cold start benchmark for the Lambda handlers.
+
+Extracts the layers in lib/ the way Lambda mounts them under /opt, then imports each handler module in a fresh
+interpreter with -X importtime. Reports the median init time per handler and the imports that cost the most.
+
+Usage: python benchmarks/cold_start.py [--runs 5] [--top 5] [handler ...]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+lambda_dir = os.path.join(root, 'lambda')
+lib_dir = os.path.join(root, 'lib')
+
+handlers = { # Handler module -> layers attached to its function in enricher_cdk_stack.py
+    'csv_code': ['slugify_lib'],
+    'split_code': [],
+    'sns': [],
+    'vt': ['slugify_lib', 'requests_lib'],
+    'vt_quota': [],
+    'dns_code': ['slugify_lib', 'dns_lib'],
+    'whois_code': ['slugify_lib', 'whois_lib', 'ipwhois_lib'],
+    'html_code': ['slugify_lib', 'bs4_lib'],
+    'cert': ['slugify_lib', 'crtsh_lib'],
+    'hist': ['slugify_lib', 'waybackpy_lib', 'requests_lib']
+}
+
+environment = { # Values the handlers read at import time. Nothing is called, so they only need to exist.
+    'AWS_DEFAULT_REGION': 'ap-southeast-1',
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    'DB_ID': 'benchmark',
+    'S3_ID': 'benchmark',
+    'CACHE_ID': 'benchmark',
+    'TOPIC_ARN': 'arn:aws:sns:ap-southeast-1:123456789012:benchmark',
+    'QUEUE_URL': 'https://sqs.ap-southeast-1.amazonaws.com/123456789012/benchmark',
+    'QUEUES': '{"high": {"url": "benchmark", "arn": "arn:aws:sqs:ap-southeast-1:123456789012:benchmark"}}',
+    'VT_FUNCTION_ID': 'benchmark',
+    'API_KEY': 'benchmark',
+    'CSV_FUNCTION_ID': 'benchmark',
+    'SUBNET_IDS': 'benchmark',
+    'SECURITY_GROUP_ID': 'benchmark',
+    'ECS_CLUSTER_ID': 'benchmark',
+    'ECS_TASKDEFINITION_ID': 'benchmark'
+}
+
+probe = "import time; start = time.perf_counter(); import {module}; print((time.perf_counter() - start) * 1000)"
+
+def extract_layers(directory):
+    """ Returns layer name -> paths Lambda would add to sys.path for it """
+    paths = {}
+    for name in sorted(os.listdir(lib_dir)):
+        if not name.endswith('.zip'):
+            continue
+        layer = name[:-len('.zip')]
+        target = os.path.join(directory, layer)
+        with zipfile.ZipFile(os.path.join(lib_dir, name)) as archive:
+            archive.extractall(target)
+        paths[layer] = [
+            os.path.join(target, 'python'),
+            os.path.join(target, 'python', 'lib', f"python{sys.version_info.major}.{sys.version_info.minor}", 'site-packages'),
+            os.path.join(target, 'python', 'lib', 'python3.13', 'site-packages') # Layers built for the Lambda runtime
+        ]
+    return paths
+
+def parse_importtime(stderr, top):
+    """ Modules imported directly by the handler, by cumulative time in ms """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2 # Names are indented two spaces per level after one separator space
+        if depth == 1: # Depth 0 is the handler itself
+            imports.append((int(cumulative_us) / 1000, name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+def measure(module, layer_paths, runs, top):
+    env = dict(os.environ, **environment)
+    env['PYTHONPATH'] = os.pathsep.join([lambda_dir] + [path for layer in handlers[module] for path in layer_paths.get(layer, [])])
+    env['PYTHONDONTWRITEBYTECODE'] = '1' # Every run pays for compiling, as a fresh Lambda sandbox would without bundled .pyc files
+    times = []
+    imports = []
+    for run in range(runs):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', probe.format(module=module)],
+            env=env,
+            capture_output=True,
+            text=True
+        )
+        if result.returncode != 0:
+            return None, result.stderr.strip().splitlines()[-1]
+        times.append(float(result.stdout.strip().splitlines()[-1]))
+        imports = parse_importtime(result.stderr, top)
+    return statistics.median(times), imports
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('handlers', nargs='*', default=list(handlers), help="Handler modules to measure (default: all)")
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters per handler")
+    parser.add_argument('--top', type=int, default=5, help="Most expensive direct imports to list per handler")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        layer_paths = extract_layers(directory)
+        print(f"Python {sys.version.split()[0]}, median of {args.runs} runs\n")
+        print(f"{'handler':<12} {'init ms':>9}  slowest direct imports (cumulative ms)")
+        for module in args.handlers:
+            init_ms, imports = measure(module, layer_paths, args.runs, args.top)
+            if init_ms is None:
+                print(f"{module:<12} {'failed':>9}  {imports}")
+                continue
+            breakdown = ', '.join(f"{name} {ms:.1f}" for ms, name in imports)
+            print(f"{module:<12} {init_ms:>9.1f}  {breakdown}")
+
+if __name__ == '__main__':
+    main()
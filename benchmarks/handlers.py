@@ -0,0 +1,326 @@
+""" Throughput benchmark for the Lambda handlers.
+
+Runs each lambda_handler in its own process against moto-backed S3/DynamoDB/SQS/SNS and the local stand-ins in
+benchmarks/standins.py, and reports records/sec, p50/p99 latency and peak RSS. Latency is per record for the enrichment
+modules and per invocation for sns and csv_code. Uses the packages installed locally rather than the layers in lib/,
+so install moto, dnspython, python-whois, crtsh, waybackpy, beautifulsoup4 and python-slugify first.
+
+The modules' pacing sleeps (12 s per crt.sh request, 2 s per page) are skipped unless --sleep-scale is set, so the
+numbers reflect the code and the stand-in latency rather than the sleeps. VT runs without a quota table, so it takes no
+tokens from the rate limiter. Each module runs with the CONCURRENCY and HOST_CONCURRENCY it is deployed with, unless
+--concurrency is set.
+
+Usage: python benchmarks/handlers.py [--records 200] [--batch N] [--latency-ms 20] [--concurrency N]
+                                     [--save results.json] [--baseline results.json] [handler ...]
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import types
+import uuid
+from contextlib import redirect_stdout
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+handlers = { # Handler module -> batch size of its event source in enricher_cdk_stack.py (rows per file for csv_code)
+    'vt': 120,
+    'dns_code': 30,
+    'whois_code': 45,
+    'cert': 15,
+    'hist': 8,
+    'html_code': 30,
+    'sns': 100,
+    'csv_code': 1000
+}
+
+deployed = { # Handler module -> CONCURRENCY and HOST_CONCURRENCY as deployed in enricher_cdk_stack.py
+    'vt': {'CONCURRENCY': '1', 'HOST_CONCURRENCY': '{"www.virustotal.com": 1}'},
+    'dns_code': {'CONCURRENCY': '16'},
+    'whois_code': {'CONCURRENCY': '8', 'HOST_CONCURRENCY': '{"whois": 4, "rdap": 4}'},
+    'cert': {'CONCURRENCY': '4', 'HOST_CONCURRENCY': '{"crt.sh": 1}'},
+    'hist': {'CONCURRENCY': '4', 'HOST_CONCURRENCY': '{"web.archive.org": 2}'},
+    'html_code': {'CONCURRENCY': '8', 'HOST_CONCURRENCY': '{"*": 2}'}
+}
+
+environment = {
+    'AWS_DEFAULT_REGION': 'ap-southeast-1',
+    'AWS_REGION': 'ap-southeast-1',
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    'DB_ID': 'benchmark-table',
+    'S3_ID': 'benchmark-bucket',
+    'API_KEY': 'benchmark',
+    'QUEUE_URL': 'https://sqs.ap-southeast-1.amazonaws.com/123456789012/benchmark',
+    'TOPIC_ARN': 'arn:aws:sns:ap-southeast-1:123456789012:benchmark',
+    'SUBNET_IDS': 'benchmark',
+    'SECURITY_GROUP_ID': 'benchmark',
+    'ECS_CLUSTER_ID': 'benchmark',
+    'ECS_TASKDEFINITION_ID': 'benchmark'
+}
+
+modules = ['vt', 'dns', 'whois', 'html', 'cert', 'hist', 'ss']
+
+class Context:
+    log_stream_name = 'benchmark'
+    log_group_name = 'benchmark'
+    function_name = 'benchmark'
+
+    def __init__(self):
+        self.aws_request_id = str(uuid.uuid4())
+
+    def get_remaining_time_in_millis(self):
+        return 15 * 60 * 1000
+
+def create_resources():
+    import boto3
+    boto3.client('dynamodb').create_table(
+        TableName=environment['DB_ID'],
+        KeySchema=[
+            {'AttributeName': 'UploadFileName', 'KeyType': 'HASH'},
+            {'AttributeName': 'TimeStamp', 'KeyType': 'RANGE'}
+        ],
+        AttributeDefinitions=[
+            {'AttributeName': 'UploadFileName', 'AttributeType': 'S'},
+            {'AttributeName': 'TimeStamp', 'AttributeType': 'S'}
+        ],
+        BillingMode='PAY_PER_REQUEST'
+    )
+    boto3.client('s3').create_bucket(
+        Bucket=environment['S3_ID'],
+        CreateBucketConfiguration={'LocationConstraint': environment['AWS_DEFAULT_REGION']}
+    )
+    boto3.client('sns').create_topic(Name='benchmark')
+    boto3.client('sqs').create_queue(QueueName='benchmark')
+
+def patch_upstreams(ports):
+    """ Sends the libraries with hard coded hosts to the stand-ins """
+    import socket
+    import requests
+    import whois
+    import dns.resolver
+    import standins
+
+    http = f"http://127.0.0.1:{ports['http']}"
+    request = requests.sessions.Session.request
+    def local_request(self, method, url, *args, **kwargs):
+        for host in ('https://crt.sh', 'https://web.archive.org'):
+            if url.startswith(host):
+                url = http + url[len(host):]
+        return request(self, method, url, *args, **kwargs)
+    requests.sessions.Session.request = local_request
+
+    standins.RedirectedSocket.port = ports['whois']
+    whois.NICClient.get_socket = lambda self: standins.RedirectedSocket(socket.AF_INET, socket.SOCK_STREAM)
+    whois.NICClient.choose_server = lambda self, domain: 'whois.benchmark' # Skips the IANA referral lookup
+    whois.NICClient.findwhois_server = lambda self, response, hostname, query: None
+
+    class LocalResolver(dns.resolver.Resolver):
+        def __init__(self, *args, **kwargs):
+            super().__init__(configure=False)
+
+        def resolve(self, *args, **kwargs):
+            self.nameservers = ['127.0.0.1'] # Set on every call since handlers overwrite it
+            self.port = ports['dns']
+            return super().resolve(*args, **kwargs)
+    dns.resolver.Resolver = LocalResolver
+    dns.resolver.default_resolver = LocalResolver()
+
+def patch_handler(handler, sleep_scale):
+    """ Scales the module's pacing sleeps """
+    if hasattr(handler, 'time'):
+        sleep = time.sleep
+        handler.time = types.SimpleNamespace(**{
+            name: getattr(time, name) for name in dir(time) if not name.startswith('_')
+        })
+        handler.time.sleep = lambda seconds: sleep(seconds * sleep_scale) if sleep_scale else None
+
+def indicator(name, i, ports):
+    if name == 'html_code':
+        return f"127.0.0.1:{ports['http']}/page-{i}"
+    return f"bench-{i}.com"
+
+def sqs_event(rows):
+    records = []
+    for row in rows:
+        records.append({
+            'messageId': str(uuid.uuid4()),
+            'receiptHandle': str(uuid.uuid4()),
+            'body': json.dumps({
+                'Type': 'Notification',
+                'Message': f"New file uploaded: {row['UploadFileName']}---{row['TimeStamp']}",
+                'MessageAttributes': {key: {'Type': 'String', 'Value': value} for key, value in row.items()}
+            }),
+            'attributes': {'SentTimestamp': str(int(time.time() * 1000))},
+            'eventSourceARN': 'arn:aws:sqs:ap-southeast-1:123456789012:benchmark'
+        })
+    return {'Records': records}
+
+def stream_event(rows):
+    return {'Records': [
+        {
+            'eventName': 'INSERT',
+            'dynamodb': {
+                'NewImage': {key: {'S': value} for key, value in row.items()},
+                'SequenceNumber': str(i)
+            }
+        }
+        for i, row in enumerate(rows)
+    ]}
+
+def upload_csv(rows, key):
+    import boto3
+    import csv
+    import io
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=['domain'])
+    writer.writeheader()
+    writer.writerows({'domain': row['domain']} for row in rows)
+    metadata = {f"{module}_status": '0' for module in modules if module != 'ss'}
+    metadata['ss_status'] = '1' # No screenshot tasks
+    boto3.client('s3').put_object(Bucket=environment['S3_ID'], Key=key, Body=output.getvalue(), Metadata=metadata)
+    return {'Records': [{'s3': {'bucket': {'name': environment['S3_ID']}, 'object': {'key': key}}}]}
+
+def run_child(name, args):
+    """ Runs one handler and returns its measurements """
+    os.environ.update(environment)
+    os.environ.update(deployed.get(name, {}))
+    if args.concurrency:
+        os.environ['CONCURRENCY'] = str(args.concurrency)
+    import standins
+    from moto import mock_aws
+
+    ports = standins.start(args.latency_ms)
+    os.environ['VT_URL'] = f"http://127.0.0.1:{ports['http']}/api/v3"
+    os.environ['UPSTREAMS'] = f"127.0.0.1:{ports['dns']}" # dns_pool
+    mock = mock_aws()
+    mock.start()
+    create_resources()
+    patch_upstreams(ports)
+
+    sys.path.insert(0, os.path.join(root, 'lambda'))
+    handler = __import__(name)
+    patch_handler(handler, args.sleep_scale)
+
+    latencies = []
+    if hasattr(handler, 'process'): # Enrichment modules, timed per record
+        process = handler.process
+        def timed_process(record, context):
+            start = time.perf_counter()
+            try:
+                return process(record, context)
+            finally:
+                latencies.append((time.perf_counter() - start) * 1000)
+        handler.process = timed_process
+
+    if name == 'csv_code': # moto returns user metadata keys with dashes instead of underscores
+        get_object = handler.s3.get_object
+        def local_get_object(**kwargs):
+            response = get_object(**kwargs)
+            response['Metadata'] = {key.replace('-', '_'): value for key, value in response['Metadata'].items()}
+            return response
+        handler.s3.get_object = local_get_object
+
+    batch = args.batch or handlers[name]
+    rows = [
+        {'UploadFileName': 'benchmark.csv', 'TimeStamp': f"{i:012d}", 'domain': indicator(name, i, ports)}
+        for i in range(args.records)
+    ]
+    if name == 'sns':
+        for row in rows:
+            row.update({f"{module}_status": '0' for module in modules})
+    events = []
+    for i in range(0, len(rows), batch):
+        if name == 'sns':
+            events.append(stream_event(rows[i:i + batch]))
+        elif name == 'csv_code':
+            events.append(upload_csv(rows[i:i + batch], f"upload/benchmark-{i}.csv"))
+        else:
+            events.append(sqs_event(rows[i:i + batch]))
+
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull): # Handlers log every record
+        for event in events:
+            invocation_start = time.perf_counter()
+            handler.lambda_handler(event, Context())
+            if not hasattr(handler, 'process'):
+                latencies.append((time.perf_counter() - invocation_start) * 1000)
+    elapsed = time.perf_counter() - start
+
+    statuses = {} # Status counts, so a run where every lookup failed is not mistaken for a fast one
+    if hasattr(handler, 'worker'):
+        import boto3
+        table = boto3.resource('dynamodb').Table(environment['DB_ID'])
+        for item in table.scan()['Items']:
+            status = item.get(handler.worker.status_attr, 'none')
+            statuses[status] = statuses.get(status, 0) + 1
+    mock.stop()
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024) if sys.platform == 'darwin' else peak_rss / 1024 # Bytes on macOS, KiB on Linux
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        'handler': name,
+        'records': args.records,
+        'latency_unit': 'record' if hasattr(handler, 'process') else 'invocation',
+        'records_per_sec': args.records / elapsed,
+        'p50_ms': quantiles[49],
+        'p99_ms': quantiles[98],
+        'peak_rss_mb': peak_rss_mb,
+        'statuses': statuses
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('handlers', nargs='*', default=list(handlers), help="Handlers to run (default: all)")
+    parser.add_argument('--records', type=int, default=200, help="Records per handler")
+    parser.add_argument('--batch', type=int, help="Records per invocation (default: the event source batch size)")
+    parser.add_argument('--latency-ms', type=float, default=20, help="Delay before each stand-in response")
+    parser.add_argument('--concurrency', type=int, help="CONCURRENCY for the enrichment modules (default: as deployed)")
+    parser.add_argument('--sleep-scale', type=float, default=0, help="Fraction of the modules' pacing sleeps to keep")
+    parser.add_argument('--save', help="Write the results to this JSON file")
+    parser.add_argument('--baseline', help="Compare against results saved earlier with --save")
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print('RESULT ' + json.dumps(run_child(args.child, args)))
+        return
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = {result['handler']: result for result in json.load(file)}
+
+    passthrough = [arg for arg in sys.argv[1:] if arg not in args.handlers]
+    results = []
+    print(f"{'handler':<12} {'records/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'RSS MB':>8}  {'latency per':<11}  statuses")
+    for name in args.handlers:
+        process = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', name] + passthrough,
+            capture_output=True,
+            text=True
+        )
+        lines = [line for line in process.stdout.splitlines() if line.startswith('RESULT ')]
+        if process.returncode != 0 or not lines:
+            print(f"{name:<12} failed: {(process.stderr.strip().splitlines() or ['no output'])[-1]}")
+            continue
+        result = json.loads(lines[-1][len('RESULT '):])
+        results.append(result)
+        line = f"{name:<12} {result['records_per_sec']:>10.1f} {result['p50_ms']:>9.1f} {result['p99_ms']:>9.1f} {result['peak_rss_mb']:>8.1f}  {result['latency_unit']:<11}  {', '.join(f'{k}: {v}' for k, v in sorted(result['statuses'].items()))}"
+        if name in baseline:
+            before = baseline[name]
+            line += f"  (records/s {100 * (result['records_per_sec'] / before['records_per_sec'] - 1):+.0f}%, p99 {100 * (result['p99_ms'] / before['p99_ms'] - 1):+.0f}%)"
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+""" Local stand-ins for the services the enrichment modules call, each answering after a configurable latency.
+
+HTTP serves VirusTotal, crt.sh, the Wayback Machine CDX API and the web pages html_code fetches. DNS answers A, AAAA, NS
+and CNAME queries (names starting with "nx" are NXDOMAIN). WHOIS answers port 43 style queries with a .com record.
+"""
+import json
+import socket
+import socketserver
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+page = """<html><head>
+<script src="/static/app.js"></script>
+<script src="//{host}/static/vendor.js"></script>
+<script src="static/analytics.js"></script>
+</head><body><a href="/download/app.apk">Download</a>{padding}</body></html>"""
+
+def vt_report(name):
+    return {'data': {'id': name, 'type': 'domain', 'attributes': {
+        'last_analysis_stats': {'harmless': 70, 'malicious': 0, 'suspicious': 0, 'undetected': 20},
+        'categories': {'benchmark': 'test'},
+        'whois': 'Registrar: Benchmark Registrar\n' * 20
+    }}}
+
+def crtsh_certificates(name):
+    name = name.lstrip('%.')
+    return [
+        {
+            'issuer_ca_id': 16418,
+            'issuer_name': "C=US, O=Let's Encrypt, CN=R3",
+            'common_name': name,
+            'name_value': f"{name}\nwww.{name}",
+            'id': 1000 + i,
+            'serial_number': f"0{i}ab",
+            'not_before': '2024-01-01T00:00:00',
+            'not_after': '2024-04-01T00:00:00'
+        }
+        for i in range(3)
+    ]
+
+class HTTPHandler(BaseHTTPRequestHandler):
+    latency = 0
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path.startswith('/api/v3/'): # VirusTotal
+            self.reply(200, json.dumps(vt_report(url.path.rsplit('/', 1)[-1])), 'application/json')
+        elif 'q' in query and query.get('output') == ['json']: # crt.sh
+            self.reply(200, json.dumps(crtsh_certificates(query['q'][0])), 'application/json')
+        elif url.path == '/cdx/search/cdx': # Wayback Machine CDX API
+            original = query.get('url', ['example.com'])[0]
+            line = f"com,example)/ 20240101000000 http://{original}/ text/html 200 {'A' * 32} 1234"
+            self.reply(200, line + '\n', 'text/plain')
+        elif url.path.endswith('.js'):
+            self.reply(200, 'console.log("benchmark");\n' * 200, 'application/javascript')
+        else:
+            self.reply(200, page.format(host=self.headers.get('Host'), padding='<p>benchmark</p>' * 500), 'text/html')
+
+    def reply(self, status, body, content_type):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class DNSHandler(socketserver.BaseRequestHandler):
+    latency = 0
+
+    def handle(self):
+        import dns.message
+        import dns.rcode
+        import dns.rdatatype
+        import dns.rrset
+        data, sock = self.request
+        time.sleep(self.latency)
+        query = dns.message.from_wire(data)
+        response = dns.message.make_response(query)
+        question = query.question[0]
+        name = question.name
+        if name.to_text().startswith('nx'):
+            response.set_rcode(dns.rcode.NXDOMAIN)
+        elif question.rdtype == dns.rdatatype.A:
+            response.answer.append(dns.rrset.from_text(name, 300, 'IN', 'A', '10.0.0.1', '10.0.0.2'))
+        elif question.rdtype == dns.rdatatype.NS:
+            response.answer.append(dns.rrset.from_text(name, 3600, 'IN', 'NS', 'ns1.benchmark.com.', 'ns2.benchmark.com.'))
+        # AAAA and CNAME get an empty answer, which resolvers report as NoAnswer
+        sock.sendto(response.to_wire(), self.client_address)
+
+class WhoisHandler(socketserver.StreamRequestHandler):
+    latency = 0
+
+    def handle(self):
+        domain = self.rfile.readline().decode('utf-8').strip()
+        time.sleep(self.latency)
+        self.wfile.write((
+            f"   Domain Name: {domain.upper()}\r\n"
+            "   Registrar: Benchmark Registrar, Inc.\r\n"
+            "   Updated Date: 2024-01-01T00:00:00Z\r\n"
+            "   Creation Date: 2020-01-01T00:00:00Z\r\n"
+            "   Registry Expiry Date: 2030-01-01T00:00:00Z\r\n"
+            "   Name Server: NS1.BENCHMARK.COM\r\n"
+            "   Name Server: NS2.BENCHMARK.COM\r\n"
+        ).encode('utf-8'))
+
+class ThreadingUDPServer(socketserver.ThreadingMixIn, socketserver.UDPServer):
+    daemon_threads = True
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def serve(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+def start(latency_ms):
+    """ Starts all stand-ins on free local ports. Returns {'http': port, 'dns': port, 'whois': port}. """
+    latency = latency_ms / 1000
+    handlers = {
+        'http': type('HTTP', (HTTPHandler,), {'latency': latency}),
+        'dns': type('DNS', (DNSHandler,), {'latency': latency}),
+        'whois': type('Whois', (WhoisHandler,), {'latency': latency})
+    }
+    http_server = ThreadingHTTPServer(('127.0.0.1', 0), handlers['http'])
+    http_server.daemon_threads = True
+    return {
+        'http': serve(http_server),
+        'dns': serve(ThreadingUDPServer(('127.0.0.1', 0), handlers['dns'])),
+        'whois': serve(ThreadingTCPServer(('127.0.0.1', 0), handlers['whois']))
+    }
+
+class RedirectedSocket(socket.socket):
+    """ Socket that connects to a local stand-in whatever address it is given """
+    port = None
+
+    def connect(self, address):
+        super().connect(('127.0.0.1', self.port))
@@ -23,9 +23,20 @@ from constructs import Construct
 # User information (NEED TO UPDATE)
 region = 'ap-southeast-1'
 account = 'XXXXX'
-email = 'XXXXX' # Email notification if VT quota exceeded and Lambda failed to disable (will cause looping function)
 vt_group_id = 'XXXXX'
 vt_api_key = 'XXXXX'
+vt_rate_per_minute = '4' # VT API allowance for the key (public API: 4 per minute, 500 per day)
+vt_daily_quota = '500'
+# Uploads set their priority with S3 object metadata (x-amz-meta-priority: high, normal or low). Missing or other values are normal.
+
+# AWS SDK for pandas managed layer, provides pyarrow for Parquet and .zst uploads (NEED TO UPDATE: latest version for the region)
+pandas_layer_arn = f'arn:aws:lambda:{region}:336392948345:layer:AWSSDKPandas-Python313:XXXXX'
+
+# Receives of a message before it moves to the dead-letter queue. Deferrals before the Lambda timeout and VT quota waits count too.
+max_receive_count = 10
+
+# "true" appends module results to per-upload segment files with an offset index instead of one S3 object per result
+packed_output = "false"
 
 # VPC information (NEED TO UPDATE)
 subnet_ids = ['XXXXX']
@@ -66,6 +77,34 @@ class EnricherCdkStack(Stack):
         )
         CfnOutput(self, "db_table_name", value=db_table.table_name)
 
+        cache_table = dynamodb.Table(
+            self, "cache",
+            partition_key=dynamodb.Attribute(
+                name="CacheKey", # <module>#<normalized indicator>, or parts#<bucket>/<key>#<version> for split uploads
+                type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            encryption=dynamodb.TableEncryption.AWS_MANAGED,
+            time_to_live_attribute="ExpiresAt",
+            # table_name=cache_id,
+            removal_policy=RemovalPolicy.DESTROY
+        )
+        CfnOutput(self, "cache_table_name", value=cache_table.table_name)
+
+        quota_table = dynamodb.Table(
+            self, "quota",
+            partition_key=dynamodb.Attribute(
+                name="BucketKey", # <api> token bucket, or <api>#<UTC day> daily counter
+                type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            encryption=dynamodb.TableEncryption.AWS_MANAGED,
+            time_to_live_attribute="ExpiresAt",
+            # table_name=quota_id,
+            removal_policy=RemovalPolicy.DESTROY
+        )
+        CfnOutput(self, "quota_table_name", value=quota_table.table_name)
+
         sns_topic = sns.Topic(
             self, "sns",
             # topic_name=sns_id
@@ -144,10 +183,23 @@ class EnricherCdkStack(Stack):
             layer_version_name="requests"
         )
 
+        pandas_lib = _lambda.LayerVersion.from_layer_version_arn(
+            self, "pandas_lib",
+            pandas_layer_arn
+        )
+
+        sqs_dead_letter = sqs.Queue( # Shared by the module queues. Redrive returns each message to the queue it came from.
+            self, "sqs_dead_letter",
+            retention_period=Duration.days(14)
+        )
+        CfnOutput(self, "sqs_dead_letter_name", value=sqs_dead_letter.queue_name)
+        dead_letter_queue = sqs.DeadLetterQueue(max_receive_count=max_receive_count, queue=sqs_dead_letter)
+
         sqs_ss = sqs.Queue(
             self, "sqs_ss",
             visibility_timeout=Duration.minutes(5), # 10 messages per batch, 20s timeout -> 10 * 20 = 200s at least
             retention_period=Duration.days(4),
+            dead_letter_queue=dead_letter_queue,
             # queue_name=sqs_ss_id
         )
         CfnOutput(self, "sqs_ss_name", value=sqs_ss.queue_name)
@@ -221,31 +273,21 @@ class EnricherCdkStack(Stack):
             handler="csv_code.lambda_handler",
             code=_lambda.Code.from_asset("lambda"),
             timeout=Duration.minutes(15),
-            layers=[slugify_lib],
+            memory_size=1024, # pyarrow needs more than the default 128 MB to read Parquet uploads
+            layers=[slugify_lib, pandas_lib], # pyarrow in the pandas layer reads Parquet and decompresses .zst
             environment={
                 "SUBNET_IDS": ",".join(subnet_ids),
                 "SECURITY_GROUP_ID": sg_id,
                 "DB_ID": db_table.table_name,
+                "CACHE_ID": cache_table.table_name,
                 "ECS_CLUSTER_ID": ecs_cluster.cluster_name,
-                "ECS_TASKDEFINITION_ID": ecs_td.family
+                "ECS_TASKDEFINITION_ID": ecs_td.family,
+                "INGEST_WRITERS": "4" # Parallel BatchWriteItem calls
             },
             # function_name=lambda_csv_id
         )
         CfnOutput(self, "lambda_csv_name", value=lambda_csv.function_name)
 
-        lambda_csv.add_event_source(
-            eventsources.S3EventSource(
-                s3_bucket,
-                events=[s3.EventType.OBJECT_CREATED_PUT],
-                filters=[s3.NotificationKeyFilter(prefix="upload/", suffix=".csv")]
-            )
-        )
-
-        lambda_csv.add_permission(
-            "AllowS3Invoke",
-            principal=iam.ServicePrincipal("s3.amazonaws.com"),
-            source_arn=s3_bucket.bucket_arn
-        )
         lambda_csv.add_to_role_policy(
             iam.PolicyStatement(
                 actions=["ecs:RunTask", "iam:PassRole"],
@@ -254,6 +296,38 @@ class EnricherCdkStack(Stack):
         )
         s3_bucket.grant_read(lambda_csv)
         db_table.grant_read_write_data(lambda_csv)
+        cache_table.grant_read_write_data(lambda_csv) # Part counters of split uploads
+
+        lambda_split = _lambda.Function(
+            self, "lambda_split",
+            runtime=_lambda.Runtime.PYTHON_3_13,
+            handler="split_code.lambda_handler",
+            code=_lambda.Code.from_asset("lambda"),
+            timeout=Duration.minutes(5),
+            environment={
+                "CSV_FUNCTION_ID": lambda_csv.function_name,
+                "SPLIT_BYTES": str(32 * 1024 * 1024) # Uploads larger than this are ingested by several csv_code workers in parallel
+            },
+            # function_name=lambda_split_id
+        )
+        CfnOutput(self, "lambda_split_name", value=lambda_split.function_name)
+
+        for suffix in [".csv", ".csv.gz", ".csv.zst", ".parquet"]: # S3 allows one suffix per notification filter
+            lambda_split.add_event_source(
+                eventsources.S3EventSource(
+                    s3_bucket,
+                    events=[s3.EventType.OBJECT_CREATED_PUT],
+                    filters=[s3.NotificationKeyFilter(prefix="upload/", suffix=suffix)]
+                )
+            )
+
+        lambda_split.add_permission(
+            "AllowS3Invoke",
+            principal=iam.ServicePrincipal("s3.amazonaws.com"),
+            source_arn=s3_bucket.bucket_arn
+        )
+        s3_bucket.grant_read(lambda_split)
+        lambda_csv.grant_invoke(lambda_split)
 
         lambda_sns = _lambda.Function(
             self, "lambda_sns",
@@ -261,9 +335,10 @@ class EnricherCdkStack(Stack):
             handler="sns.lambda_handler",
             code=_lambda.Code.from_asset("lambda"),
             timeout=Duration.minutes(5),
-            reserved_concurrent_executions=1,
             environment={
-                "TOPIC_ARN": sns_topic.topic_arn
+                "TOPIC_ARN": sns_topic.topic_arn,
+                "DB_ID": db_table.table_name,
+                "PUBLISH_WORKERS": "8" # Parallel PublishBatch calls per invocation
             },
             # function_name=lambda_sns_id
         )
@@ -274,9 +349,10 @@ class EnricherCdkStack(Stack):
                 db_table,
                 batch_size=1000,
                 max_batching_window=Duration.minutes(1),
-                parallelization_factor=1,
+                parallelization_factor=10, # Up to 10 concurrent batches per shard. Records of the same upload stay in order within a partition key
                 retry_attempts=3,
                 bisect_batch_on_error=True,
+                report_batch_item_failures=True,
                 starting_position=_lambda.StartingPosition.LATEST,
                 filters=[
                     _lambda.FilterCriteria.filter({
@@ -289,44 +365,26 @@ class EnricherCdkStack(Stack):
         db_table.grant_read_write_data(lambda_sns)
         sns_topic.grant_publish(lambda_sns)
 
-        sqs_vt = sqs.Queue(
-            self, "sqs_vt",
-            visibility_timeout=Duration.minutes(8),
-            retention_period=Duration.days(7),
-            # queue_name=sqs_vt_id
-        )
-        CfnOutput(self, "sqs_vt_name", value=sqs_vt.queue_name)
-
-        sns_topic.add_subscription(
-            subscriptions.SqsSubscription(
-                sqs_vt,
-                filter_policy={
-                    "vt_status": sns.SubscriptionFilter.string_filter(allowlist=["0"])
-                }
+        vt_queues = {} # Priority lane (from the upload's priority metadata, set by sns.py) -> queue. Normal keeps the original queue.
+        for priority, queue_id in (("high", "sqs_vt_high"), ("normal", "sqs_vt"), ("low", "sqs_vt_low")):
+            vt_queues[priority] = sqs.Queue(
+                self, queue_id,
+                visibility_timeout=Duration.minutes(8),
+                retention_period=Duration.days(7),
+                dead_letter_queue=dead_letter_queue,
+                # queue_name=sqs_vt_id
             )
-        )
-
-        sns_topic.add_subscription(
-            subscriptions.EmailSubscription(
-                email,
-                filter_policy_with_message_body={
-                    "Body": sns.FilterOrPolicy.filter(
-                        sns.SubscriptionFilter.string_filter(allowlist=["WARNING: VT quota exceeded and failed to disable Lambda function"])
-                    )
-                }
+            CfnOutput(self, f"{queue_id}_name", value=vt_queues[priority].queue_name)
+
+            sns_topic.add_subscription(
+                subscriptions.SqsSubscription(
+                    vt_queues[priority],
+                    filter_policy={
+                        "vt_status": sns.SubscriptionFilter.string_filter(allowlist=["0"]),
+                        "priority": sns.SubscriptionFilter.string_filter(allowlist=[priority])
+                    }
+                )
             )
-        )
-
-        self.lambda_vt_quota = _lambda.Function(
-            self, "lambda_vt_quota",
-            runtime=_lambda.Runtime.PYTHON_3_13,
-            handler="vt_quota.lambda_handler",
-            code=_lambda.Code.from_asset("lambda"),
-            timeout=Duration.minutes(5),
-            reserved_concurrent_executions=1
-            # function_name=lambda_vt_quota_id
-        )
-        CfnOutput(self, "lambda_vt_quota_name", value=self.lambda_vt_quota.function_name)
 
         self.lambda_vt = _lambda.Function(
             self, "lambda_vt",
@@ -335,63 +393,63 @@ class EnricherCdkStack(Stack):
             code=_lambda.Code.from_asset("lambda"),
             timeout=Duration.minutes(8),
             reserved_concurrent_executions=50,
-            layers=[slugify_lib],
+            layers=[slugify_lib, requests_lib], # urllib3 for the pooled VT client
             environment={
                 "S3_ID": s3_bucket.bucket_name,
                 "DB_ID": db_table.table_name,
+                "PACKED_OUTPUT": packed_output,
                 "API_KEY": vt_api_key,
-                "QUEUE_URL": sqs_vt.queue_url,
-                "TOPIC_ARN": sns_topic.topic_arn,
+                "CACHE_ID": cache_table.table_name,
+                "CONCURRENCY": "1", # VT requests are paced by the shared token bucket
+                "HOST_CONCURRENCY": '{"www.virustotal.com": 1}',
+                "QUOTA_ID": quota_table.table_name,
+                "VT_RATE_PER_MINUTE": vt_rate_per_minute,
+                "VT_DAILY_QUOTA": vt_daily_quota,
             },
             # function_name=lambda_vt_id
         )
         CfnOutput(self, "lambda_vt_name", value=self.lambda_vt.function_name)
 
-        self.lambda_vt_trigger = _lambda.EventSourceMapping(
-            self, "lambda_vt_trigger",
-            target=self.lambda_vt,
-            batch_size=120,
-            event_source_arn=sqs_vt.queue_arn,
-            max_batching_window=Duration.seconds(10),
-            max_concurrency=50
-        )
-        CfnOutput(self, "lambda_vt_trigger_uri", value=self.lambda_vt_trigger.event_source_mapping_id)
-
-        sqs_vt.grant_consume_messages(self.lambda_vt)
-        sqs_vt.grant_send_messages(self.lambda_vt)
-        sns_topic.grant_publish(self.lambda_vt)
+        for queue in vt_queues.values():
+            queue.grant_consume_messages(self.lambda_vt) # Deferred messages are made visible again by the VT Lambda
         s3_bucket.grant_write(self.lambda_vt)
         db_table.grant_read_write_data(self.lambda_vt)
-        self.lambda_vt.add_to_role_policy(
-            iam.PolicyStatement(
-                actions=[
-                    "lambda:ListEventSourceMappings"
-                ],
-                resources=["*"]
-            )
-        )
-        self.lambda_vt.add_permission( # Allows VT quota Lambda to invoke VT Lambda
-            "AllowLambdaInvoke",
-            principal=iam.ServicePrincipal("lambda.amazonaws.com"),
-            source_arn=self.lambda_vt_quota.function_arn
-        )
-        self.lambda_vt_quota.add_to_role_policy(
-            iam.PolicyStatement(
-                actions=["lambda:UpdateEventSourceMapping"],
-                resources=["*"] 
-            )
+        cache_table.grant_read_write_data(self.lambda_vt)
+        quota_table.grant_read_write_data(self.lambda_vt)
+
+        self.lambda_vt_quota = _lambda.Function( # Pulls VT messages every minute, as many as the quota allows
+            self, "lambda_vt_quota",
+            runtime=_lambda.Runtime.PYTHON_3_13,
+            handler="vt_quota.lambda_handler",
+            code=_lambda.Code.from_asset("lambda"),
+            timeout=Duration.seconds(90), # run_seconds (50 s) in vt_quota.py, plus one VT request (35 s) still running at the end
+            reserved_concurrent_executions=1,
+            retry_attempts=0, # A run that failed or was throttled behind the previous one is dropped, the next one is a minute away
+            max_event_age=Duration.minutes(1), # Shortest allowed, so throttled runs are not held and replayed later
+            environment={
+                "VT_FUNCTION_ID": self.lambda_vt.function_name,
+                "QUEUES": self.to_json_string({
+                    priority: {"url": queue.queue_url, "arn": queue.queue_arn} for priority, queue in vt_queues.items()
+                }),
+                "QUOTA_ID": quota_table.table_name,
+                "VT_RATE_PER_MINUTE": vt_rate_per_minute,
+                "VT_DAILY_QUOTA": vt_daily_quota,
+            }
+            # function_name=lambda_vt_quota_id
         )
-        self.lambda_vt_quota.grant_invoke(self.lambda_vt) # Allows VT Lambda to invoke VT quota Lambda
-        
+        CfnOutput(self, "lambda_vt_quota_name", value=self.lambda_vt_quota.function_name)
+
+        for queue in vt_queues.values():
+            queue.grant_consume_messages(self.lambda_vt_quota)
+        quota_table.grant_read_data(self.lambda_vt_quota)
+        self.lambda_vt.grant_invoke(self.lambda_vt_quota)
+
         eventbridge_vt_quota = scheduler.Schedule(
             self, "eventbridge_vt_quota",
-            schedule=scheduler.ScheduleExpression.cron(day="*", hour="0", minute="10"),
+            schedule=scheduler.ScheduleExpression.rate(Duration.minutes(1)),
             target=targets.LambdaInvoke(
                 self.lambda_vt_quota,
-                input=scheduler.ScheduleTargetInput.from_object(
-                    {"eventbridge": "True"}
-                ),
-                retry_attempts=3
+                retry_attempts=0 # The next run is a minute away
             )
         )
         CfnOutput(self, "eventbridge_vt_quota_name", value=eventbridge_vt_quota.schedule_name)
@@ -402,6 +460,7 @@ class EnricherCdkStack(Stack):
             self, "sqs_dns",
             visibility_timeout=Duration.minutes(15),
             retention_period=Duration.days(4),
+            dead_letter_queue=dead_letter_queue,
             # queue_name=sqs_dns_id
         )
         CfnOutput(self, "sqs_dns_name", value=sqs_dns.queue_name)
@@ -426,6 +485,12 @@ class EnricherCdkStack(Stack):
             environment={
                 "S3_ID": s3_bucket.bucket_name,
                 "DB_ID": db_table.table_name,
+                "PACKED_OUTPUT": packed_output,
+                "CONCURRENCY": "16",
+                "CACHE_ID": cache_table.table_name,
+                "DNS_CACHE_SHARED": "true", # Answers are also kept in the cache table (dns-answer#<name>#<type>) for other containers
+                "UPSTREAMS": "1.1.1.1,8.8.8.8,9.9.9.9", # Resolvers queried, fastest healthy one first
+                "DNS_HEDGE_MS": "200", # A query still unanswered after this long is also sent to the next resolver
             }
             # function_name=lambda_dns_id
         )
@@ -436,18 +501,21 @@ class EnricherCdkStack(Stack):
                 sqs_dns,
                 batch_size=30,
                 max_batching_window=Duration.seconds(10),
-                max_concurrency=50
+                max_concurrency=50,
+                report_batch_item_failures=True
             )
         )
 
         sqs_dns.grant_consume_messages(lambda_dns)
         s3_bucket.grant_write(lambda_dns)
         db_table.grant_read_write_data(lambda_dns)
+        cache_table.grant_read_write_data(lambda_dns)
 
         sqs_whois = sqs.Queue(
             self, "sqs_whois",
             visibility_timeout=Duration.minutes(15),
             retention_period=Duration.days(4),
+            dead_letter_queue=dead_letter_queue,
             # queue_name=sqs_whois_id
         )
         CfnOutput(self, "sqs_whois_name", value=sqs_whois.queue_name)
@@ -472,6 +540,10 @@ class EnricherCdkStack(Stack):
             environment={
                 "S3_ID": s3_bucket.bucket_name,
                 "DB_ID": db_table.table_name,
+                "PACKED_OUTPUT": packed_output,
+                "CACHE_ID": cache_table.table_name,
+                "CONCURRENCY": "8",
+                "HOST_CONCURRENCY": '{"whois": 4, "rdap": 4}',
             }
         )
         CfnOutput(self, "lambda_whois_name", value=lambda_whois.function_name)
@@ -482,18 +554,21 @@ class EnricherCdkStack(Stack):
                 sqs_whois,
                 batch_size=45,
                 max_batching_window=Duration.seconds(10),
-                max_concurrency=50
+                max_concurrency=50,
+                report_batch_item_failures=True
             )
         )
 
         sqs_whois.grant_consume_messages(lambda_whois)
         s3_bucket.grant_write(lambda_whois)
         db_table.grant_read_write_data(lambda_whois)
+        cache_table.grant_read_write_data(lambda_whois)
 
         sqs_html = sqs.Queue(
             self, "sqs_html",
             visibility_timeout=Duration.minutes(15), # Needs to be more than or equal to Lambda function timeout
             retention_period=Duration.days(4),
+            dead_letter_queue=dead_letter_queue,
             # queue_name=sqs_html_id
         )
         CfnOutput(self, "sqs_html_name", value=sqs_html.queue_name)
@@ -519,6 +594,9 @@ class EnricherCdkStack(Stack):
             environment={
                 "S3_ID": s3_bucket.bucket_name,
                 "DB_ID": db_table.table_name,
+                "PACKED_OUTPUT": packed_output,
+                "CONCURRENCY": "8",
+                "HOST_CONCURRENCY": '{"*": 2}', # Per website, including the hosts JS files are fetched from
             }
         )
         CfnOutput(self, "lambda_html_name", value=lambda_html.function_name)
@@ -528,7 +606,8 @@ class EnricherCdkStack(Stack):
                 sqs_html,
                 batch_size=30,
                 max_batching_window=Duration.seconds(10),
-                max_concurrency=50
+                max_concurrency=50,
+                report_batch_item_failures=True
             )
         )
 
@@ -540,6 +619,7 @@ class EnricherCdkStack(Stack):
             self, "sqs_cert",
             visibility_timeout=Duration.minutes(15),
             retention_period=Duration.days(4),
+            dead_letter_queue=dead_letter_queue,
             # queue_name=sqs_cert_id
         )
         CfnOutput(self, "sqs_cert_name", value=sqs_cert.queue_name)
@@ -564,6 +644,10 @@ class EnricherCdkStack(Stack):
             environment={
                 "S3_ID": s3_bucket.bucket_name,
                 "DB_ID": db_table.table_name,
+                "PACKED_OUTPUT": packed_output,
+                "CACHE_ID": cache_table.table_name,
+                "CONCURRENCY": "4", # Cache hits and S3 writes overlap, crt.sh itself is called one at a time
+                "HOST_CONCURRENCY": '{"crt.sh": 1}',
             }
         )
         CfnOutput(self, "lambda_cert_name", value=lambda_cert.function_name)
@@ -573,18 +657,21 @@ class EnricherCdkStack(Stack):
                 sqs_cert,
                 batch_size=15,
                 max_batching_window=Duration.seconds(10),
-                max_concurrency=50
+                max_concurrency=50,
+                report_batch_item_failures=True
             )
         )
 
         sqs_cert.grant_consume_messages(lambda_cert)
         s3_bucket.grant_write(lambda_cert)
         db_table.grant_read_write_data(lambda_cert)
+        cache_table.grant_read_write_data(lambda_cert)
 
         sqs_hist = sqs.Queue(
             self, "sqs_hist",
             visibility_timeout=Duration.minutes(15),
             retention_period=Duration.days(4),
+            dead_letter_queue=dead_letter_queue,
             # queue_name=sqs_hist_id
         )
         CfnOutput(self, "sqs_hist_name", value=sqs_hist.queue_name)
@@ -609,6 +696,10 @@ class EnricherCdkStack(Stack):
             environment={
                 "S3_ID": s3_bucket.bucket_name,
                 "DB_ID": db_table.table_name,
+                "PACKED_OUTPUT": packed_output,
+                "CACHE_ID": cache_table.table_name,
+                "CONCURRENCY": "4",
+                "HOST_CONCURRENCY": '{"web.archive.org": 2}',
             }
         )
         CfnOutput(self, "lambda_hist_name", value=lambda_hist.function_name)
@@ -618,10 +709,12 @@ class EnricherCdkStack(Stack):
                 sqs_hist,
                 batch_size=8,
                 max_batching_window=Duration.seconds(10),
-                max_concurrency=50
+                max_concurrency=50,
+                report_batch_item_failures=True
             )
         )
 
         sqs_hist.grant_consume_messages(lambda_hist)
         s3_bucket.grant_write(lambda_hist)
-        db_table.grant_read_write_data(lambda_hist)
\ No newline at end of file
+        db_table.grant_read_write_data(lambda_hist)
+        cache_table.grant_read_write_data(lambda_hist)
\ No newline at end of file
@@ -0,0 +1,12 @@
+import boto3
+import threading
+
+clients = {}
+lock = threading.Lock() # Creating clients from the default session is not thread safe, using them is
+
+def client(service_name):
+    """ boto3 client created on first use, so handlers only pay for the services they actually call """
+    with lock:
+        if service_name not in clients:
+            clients[service_name] = boto3.client(service_name)
+        return clients[service_name]
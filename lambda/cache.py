@@ -0,0 +1,121 @@
+import ipaddress
+import os
+import random
+import threading
+import time
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+import aws
+
+cache_id = os.environ.get('CACHE_ID') # Caching is skipped if the function has no cache table
+ttls = { # Seconds a cached result stays fresh for each module. Override with CACHE_TTL_<MODULE>.
+    'vt': 7 * 86400,
+    'whois': 30 * 86400,
+    'rdap': 7 * 86400, # Network ranges of IP WHOIS results, see rdap_index.py
+    'cert': 7 * 86400,
+    'hist': 7 * 86400
+}
+
+serializer = TypeSerializer() # Handlers look up records from several threads, so the thread safe low-level client is used
+deserializer = TypeDeserializer()
+counters = {'hits': 0, 'misses': 0}
+counters_lock = threading.Lock()
+
+def to_item(attributes):
+    return {name: deserializer.deserialize(value) for name, value in attributes.items()}
+
+def to_attributes(item):
+    return {name: serializer.serialize(value) for name, value in item.items()}
+
+def count(counter):
+    with counters_lock:
+        counters[counter] += 1
+
+def normalize(ip_or_domain):
+    """ Same indicator written differently across uploads maps to one cache key """
+    value = ip_or_domain.strip().lower().rstrip('.')
+    try:
+        return ipaddress.ip_address(value).compressed
+    except ValueError:
+        return value
+
+def cache_key(module, ip_or_domain):
+    return f"{module}#{normalize(ip_or_domain)}"
+
+def ttl(module):
+    return int(os.environ.get(f"CACHE_TTL_{module.upper()}", ttls.get(module, 86400)))
+
+def get(module, ip_or_domain):
+    """ Returns the cached item if it is still fresh, otherwise None """
+    if not cache_id:
+        return None
+    response = aws.client('dynamodb').get_item(TableName=cache_id, Key={'CacheKey': {'S': cache_key(module, ip_or_domain)}})
+    item = to_item(response['Item']) if 'Item' in response else None
+    if item and item['ExpiresAt'] > time.time(): # DynamoDB TTL deletes expired items lazily, so expiry is checked here too
+        count('hits')
+        print(f"Cache hit: {module} {ip_or_domain} (cached at {item['CachedAt']})")
+        return item
+    count('misses')
+    return None
+
+def get_many(module, values):
+    """ Like get for many values at once, 100 keys per call. Returns value -> item for the fresh ones. Unprocessed
+    keys are retried with backoff a few times, then treated as misses. Hits and misses are left to the caller to count,
+    since most keys are expected to miss. """
+    if not cache_id:
+        return {}
+    keys = {cache_key(module, value): value for value in values}
+    found = {}
+    key_list = list(keys)
+    for i in range(0, len(key_list), 100):
+        request = {cache_id: {'Keys': [{'CacheKey': {'S': key}} for key in key_list[i:i + 100]]}}
+        for attempt in range(5):
+            response = aws.client('dynamodb').batch_get_item(RequestItems=request)
+            for item in map(to_item, response['Responses'].get(cache_id, [])):
+                if item['ExpiresAt'] > time.time():
+                    found[keys[item['CacheKey']]] = item
+            request = response.get('UnprocessedKeys') # Keys DynamoDB did not get to, when the table is throttled
+            if not request:
+                break
+            time.sleep(0.05 * 2 ** attempt + random.uniform(0, 0.05))
+    return found
+
+def put(module, ip_or_domain, status, info, cached_at=None):
+    """ Stores a result for other uploads to reuse. info should not include the module's log info. cached_at is when
+    the result was looked up, if earlier than now; it expires the module's TTL after that. """
+    if not cache_id:
+        return
+    now = int(cached_at or time.time())
+    aws.client('dynamodb').put_item(
+        TableName=cache_id,
+        Item=to_attributes({
+            'CacheKey': cache_key(module, ip_or_domain),
+            'Status': status,
+            'Info': info,
+            'CachedAt': now,
+            'ExpiresAt': now + ttl(module)
+        })
+    )
+
+def delete(module, ip_or_domain):
+    """ Removes a result whose stored file was lost """
+    if not cache_id:
+        return
+    aws.client('dynamodb').delete_item(TableName=cache_id, Key={'CacheKey': {'S': cache_key(module, ip_or_domain)}})
+
+def report(module):
+    """ Logs this invocation's hit/miss counts and adds them to the module's running totals """
+    with counters_lock:
+        hits, misses = counters['hits'], counters['misses']
+        counters['hits'] = counters['misses'] = 0
+    if not cache_id or hits + misses == 0:
+        return
+    print(f"Cache {module}: {hits} hits, {misses} misses")
+    aws.client('dynamodb').update_item(
+        TableName=cache_id,
+        Key={'CacheKey': {'S': f"stats#{module}"}},
+        UpdateExpression="ADD Hits :hits, Misses :misses",
+        ExpressionAttributeValues={
+            ':hits': {'N': str(hits)},
+            ':misses': {'N': str(misses)}
+        }
+    )
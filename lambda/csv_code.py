@@ -1,64 +1,213 @@
 import urllib.parse
 import boto3
+from boto3.dynamodb.types import TypeSerializer
 import csv
+import gzip
 import io
 import datetime
+import random
 import re
+import time
+import uuid
 import os
+import metrics
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
 subnet_ids = os.environ['SUBNET_IDS'].split(',')
 sg_id = os.environ['SECURITY_GROUP_ID']
 db_id = os.environ['DB_ID']
 ecs_cluster_id = os.environ['ECS_CLUSTER_ID']
 ecs_taskdefinition_id = os.environ['ECS_TASKDEFINITION_ID']
+ingest_writers = int(os.environ.get('INGEST_WRITERS', '4')) # Number of BatchWriteItem calls in flight at once
+cache_id = os.environ.get('CACHE_ID') # Counts the stored parts of split uploads
+
+batch_size = 25 # Maximum number of items per BatchWriteItem call
+max_attempts = 8 # Attempts per batch before UnprocessedItems are treated as a failure
+screenshot_tasks = 10 # ECS tasks launched per upload
 
 ecs = boto3.client('ecs')
 s3 = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(db_id)
+dynamodb = boto3.client('dynamodb') # Low-level client is thread safe, unlike the Table resource
+serializer = TypeSerializer()
 
-def lambda_handler(event, context):
-    for record in event['Records']:
-        bucket = record['s3']['bucket']['name']
-        key = urllib.parse.unquote_plus(record['s3']['object']['key'])
-        print(f"New file uploaded: s3://{bucket}/{key}")
-    
-        """ Download file from S3 and updates DynamoDB """
-        obj = s3.get_object(Bucket=bucket, Key=key)
-        metadata = obj['Metadata']
-        body = obj['Body'].read().decode('utf-8') # Outputs a string
-        reader = csv.DictReader(io.StringIO(body)) # Converts into rows for line by line input into DynamoDB
-        for row in reader:
-            row = {
-                re.sub(r'\s+', '_', k.strip().lower()): v
-                for k, v in row.items()
-                if k.strip() != ''
-            }
-            row.update({
-                'UploadFileName': key.replace("upload/", ""),
-                'TimeStamp': datetime.datetime.now().strftime('%Y%m%d%H%M%S%f') # Sets sort key as time row was uploaded
-            })
-            row.update(metadata)
-
-            if '\ufeffip_address' in row:
-                row['ip_address'] = row.pop('\ufeffip_address')
-
-            if 'ip_address' in row: # Next few lines of codes checks for blanks. Ignores blanks. This shouldn't be a problem unless the CSV file has blank cells.
-                if row['ip_address'] == '':
-                    pass
-                else:
-                    table.put_item(Item=row)
-                    print(f"Stored to DynamoDB: {row}")
-            elif 'domain' in row:
-                if row['domain'] == '':
-                    pass
-                else:
-                    table.put_item(Item=row)
-                    print(f"Stored to DynamoDB: {row}")
+last_timestamp = [None]
+
+def next_timestamp(part=0, parts=1):
+    """ Sets sort key as time row was uploaded. Rows are built faster than the clock ticks, so keeps the key strictly increasing.
+    Workers ingesting parts of the same file only use microseconds congruent to their part number, so their keys never collide. """
+    now = datetime.datetime.now()
+    if last_timestamp[0] is not None and now <= last_timestamp[0]:
+        now = last_timestamp[0] + datetime.timedelta(microseconds=1)
+    now += datetime.timedelta(microseconds=(part - now.microsecond) % parts)
+    last_timestamp[0] = now
+    return now.strftime('%Y%m%d%H%M%S%f')
+
+def normalize_headers(fieldnames):
+    """ Works out the DynamoDB attribute name for each CSV column once per file. Blank headers are dropped later. """
+    return [re.sub(r'\s+', '_', k.strip().lower()) for k in fieldnames or []]
+
+def build_rows(reader, key, metadata, part=0, parts=1):
+    """ Drops unnamed columns and rows with a blank domain/IP """
+    for row in reader:
+        row = {k: v for k, v in row.items() if k} # None key holds surplus cells, '' key holds columns without a header
+        row.update({
+            'UploadFileName': key.replace("upload/", ""),
+            'TimeStamp': next_timestamp(part, parts),
+            'TraceId': uuid.uuid4().hex, # Trace context, carried in the SNS message body to every module
+            'IngestedAt': str(int(time.time() * 1000))
+        })
+        row.update(metadata)
+
+        if 'ip_address' in row: # Next few lines of codes checks for blanks. Ignores blanks. This shouldn't be a problem unless the CSV file has blank cells.
+            if row['ip_address'] == '':
+                pass
             else:
-                print(f"Missing domain/IP: {row}")
-            
-        if metadata['ss_status'] == "0":
+                yield row
+        elif 'domain' in row:
+            if row['domain'] == '':
+                pass
+            else:
+                yield row
+        else:
+            print(f"Missing domain/IP: {row}")
+
+def write_batch(rows, timer):
+    """ Writes up to 25 rows, retrying UnprocessedItems with exponential backoff and full jitter """
+    request_items = {
+        db_id: [
+            {'PutRequest': {'Item': {k: serializer.serialize(v) for k, v in row.items()}}}
+            for row in rows
+        ]
+    }
+    for attempt in range(max_attempts):
+        response = dynamodb.batch_write_item(RequestItems=request_items)
+        request_items = response.get('UnprocessedItems') or {}
+        if not request_items:
+            return len(rows)
+        with timer.stage('sleep'):
+            time.sleep(random.uniform(0, min(0.05 * 2 ** attempt, 5)))
+    raise Exception(f"{len(request_items[db_id])} rows unprocessed after {max_attempts} attempts")
+
+def bulk_write(rows, timer):
+    """ Writes rows in 25-item batches with several writers in parallel. Returns number of rows stored. Backoff sleeps
+    are added to timer's sleep stage. """
+    stored = 0
+    batch = []
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=ingest_writers) as executor:
+        for row in rows:
+            batch.append(row)
+            if len(batch) < batch_size:
+                continue
+            if len(in_flight) >= ingest_writers * 2: # Bounds rows held in memory while writers catch up
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                stored += sum(future.result() for future in done)
+            in_flight.add(executor.submit(write_batch, batch, timer))
+            batch = []
+        if batch:
+            in_flight.add(executor.submit(write_batch, batch, timer))
+        stored += sum(future.result() for future in in_flight)
+    return stored
+
+def read_csv(obj, key, header):
+    """ Decompresses (if needed) and decodes the S3 stream incrementally. Rows are read from the stream and written to DynamoDB as they arrive. """
+    body = obj['Body']
+    if key.endswith('.gz'):
+        body = gzip.GzipFile(fileobj=body)
+    elif key.endswith('.zst'):
+        import pyarrow # Only needed for .csv.zst uploads (AWS SDK for pandas layer, which also reads Parquet)
+        body = io.BufferedReader(pyarrow.input_stream(body, compression='zstd'))
+    lines = io.TextIOWrapper(body, encoding='utf-8-sig', newline='') # Also strips the BOM
+    if header is None:
+        reader = csv.DictReader(lines)
+        reader.fieldnames = normalize_headers(reader.fieldnames)
+    else: # Byte ranges after the first line do not contain the header row, so the splitter passes it along
+        reader = csv.DictReader(lines, fieldnames=normalize_headers(next(csv.reader([header]))))
+    return reader
+
+class RangedObject(io.RawIOBase):
+    """ Seekable file over one S3 object version, each read a ranged GET """
+    def __init__(self, request, size):
+        self.request = request
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self.position = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence] + offset
+        return self.position
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size)
+        if end <= self.position:
+            return 0
+        data = s3.get_object(**self.request, Range=f"bytes={self.position}-{end - 1}")['Body'].read()
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+def read_parquet(request, size):
+    """ Reads one record batch at a time through ranged GETs, since Parquet footers cannot be read from a forward-only stream.
+    request holds the Bucket, Key and VersionId the upload event named. """
+    import pyarrow.parquet # Only needed for .parquet uploads (AWS SDK for pandas layer)
+    parquet = pyarrow.parquet.ParquetFile(RangedObject(request, size))
+    fieldnames = normalize_headers(parquet.schema_arrow.names)
+    for group in range(parquet.num_row_groups): # One ranged GET and one row group in memory at a time
+        for batch in parquet.iter_batches(batch_size=1000, row_groups=[group]):
+            for values in zip(*(column.to_pylist() for column in batch.columns)):
+                yield {k: '' if v is None else str(v) for k, v in zip(fieldnames, values)} # Same string values as a CSV cell
+
+def last_part(bucket, key, version_id, part, parts):
+    """ Records that this part of the upload is stored and returns True if every part now is. Parts are added to a set
+    on the upload's counter item, so a retried part is not counted twice. """
+    if parts == 1:
+        return True
+    response = dynamodb.update_item(
+        TableName=cache_id,
+        Key={'CacheKey': {'S': f"parts#{bucket}/{key}#{version_id or ''}"}},
+        UpdateExpression="ADD Parts :part SET ExpiresAt = if_not_exists(ExpiresAt, :expires_at)",
+        ExpressionAttributeValues={
+            ':part': {'NS': [str(part)]},
+            ':expires_at': {'N': str(int(time.time()) + 86400)}
+        },
+        ReturnValues='ALL_NEW'
+    )
+    return len(response['Attributes']['Parts']['NS']) == parts
+
+def ingest(bucket, key, part=0, parts=1, byte_range=None, header=None, version_id=None):
+    """ Download file (or one byte range of it) from S3 and updates DynamoDB """
+    request = {'Bucket': bucket, 'Key': key}
+    if version_id:
+        request['VersionId'] = version_id
+    if key.endswith('.parquet'):
+        head = s3.head_object(**request)
+        metadata = head['Metadata']
+        reader = read_parquet(request, head['ContentLength'])
+    else:
+        if byte_range:
+            request['Range'] = f"bytes={byte_range[0]}-{byte_range[1] - 1}"
+        obj = s3.get_object(**request)
+        metadata = obj['Metadata']
+        reader = read_csv(obj, key, header)
+
+    timer = metrics.Timer()
+    current_time = time.time()
+    with timer.stage('ingest'): # Reading and writing overlap, since rows are written as they are read from the stream
+        stored = bulk_write(build_rows(reader, key, metadata, part, parts), timer)
+    duration = time.time() - current_time
+    print(f"Stored to DynamoDB: {stored} rows from {key} (part {part+1} of {parts}) in {duration:.1f}s ({stored / max(duration, 0.001):.0f} rows/sec)")
+
+    # Screenshot tasks exit once their queue has been empty for a while, so they are launched after every part is stored
+    if metadata['ss_status'] == "0" and last_part(bucket, key, version_id, part, parts):
+        with timer.stage('ecs'):
             response = ecs.run_task(
                 cluster=ecs_cluster_id,
                 launchType='FARGATE',
@@ -71,10 +220,31 @@ def lambda_handler(event, context):
                     }
                 },
                 enableExecuteCommand=True,
-                count=10
-            )  
+                count=screenshot_tasks
+            )
+    metrics.emit('csv', 'ok', timer.stages, {'rows': stored})
+
+def lambda_handler(event, context):
+    if 'split' in event: # Invoked by split_code with one byte range of a large upload
+        split = event['split']
+        print(f"Ingesting s3://{split['bucket']}/{split['key']} bytes {split['range']} (part {split['part']+1} of {split['parts']})")
+        ingest(
+            split['bucket'],
+            split['key'],
+            part=split['part'],
+            parts=split['parts'],
+            byte_range=split['range'],
+            header=split['header'],
+            version_id=split.get('version_id')
+        )
+    else:
+        for record in event['Records']:
+            bucket = record['s3']['bucket']['name']
+            key = urllib.parse.unquote_plus(record['s3']['object']['key'])
+            print(f"New file uploaded: s3://{bucket}/{key}")
+            ingest(bucket, key)
 
     return {
         'statusCode': 200,
         'body': 'CSV stored in DynamoDB'
-    }
\ No newline at end of file
+    }
@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+import dns.message
+import dns.name
+import dns.rdataclass
+import dns.rdatatype
+import dns.resolver
+import aws
+
+cache_id = os.environ.get('CACHE_ID')
+shared = os.environ.get('DNS_CACHE_SHARED') == 'true' and bool(cache_id) # Also keeps answers in the cache table for other containers
+negative_ttl = int(os.environ.get('DNS_NEGATIVE_TTL', '60')) # Seconds NXDOMAIN, no answer and SERVFAIL results are kept
+max_ttl = int(os.environ.get('DNS_MAX_TTL', '86400'))
+max_entries = int(os.environ.get('DNS_CACHE_ENTRIES', '50000')) # Per container
+
+entries = {} # (name, rdtype) -> (expires_at, status, wire). Lives across warm invocations.
+pending = [] # Entries to write to the shared table at the end of the batch
+lock = threading.Lock()
+counters = {'hits': 0, 'shared_hits': 0, 'misses': 0}
+
+negative = { # Status -> exception raised for a cached negative result
+    'NXDOMAIN': lambda name: dns.resolver.NXDOMAIN(qnames=[dns.name.from_text(name)]),
+    'NOANSWER': lambda name: dns.resolver.NoAnswer(),
+    'SERVFAIL': lambda name: dns.resolver.NoNameservers() # dnspython reports SERVFAIL from every nameserver this way
+}
+
+def normalize(name):
+    return name.strip().lower().rstrip('.')
+
+def cache_key(name, rdtype):
+    return f"dns-answer#{normalize(name)}#{rdtype}"
+
+def store(name, rdtype, expires_at, status, wire=None):
+    with lock:
+        if len(entries) >= max_entries:
+            now = time.time()
+            for key in [key for key, entry in entries.items() if entry[0] <= now]:
+                del entries[key]
+            while len(entries) >= max_entries: # Oldest first
+                del entries[next(iter(entries))]
+        entries[(normalize(name), rdtype)] = (expires_at, status, wire)
+
+def get(name, rdtype):
+    """ Returns a fresh cached Answer, raises the cached NXDOMAIN/NoAnswer/SERVFAIL error, or returns None on a miss """
+    entry = entries.get((normalize(name), rdtype))
+    if entry is None or entry[0] <= time.time():
+        counters['misses'] += 1
+        return None
+    counters['hits'] += 1
+    expires_at, status, wire = entry
+    if status != 'ANSWER':
+        raise negative[status](name)
+    return dns.resolver.Answer(dns.name.from_text(normalize(name)), dns.rdatatype.from_text(rdtype), dns.rdataclass.IN, dns.message.from_wire(wire))
+
+def put_answer(name, rdtype, answer):
+    """ Keeps an answer for the lowest TTL in it (including its CNAME chain) """
+    ttl = min(answer.expiration - time.time(), max_ttl)
+    if ttl < 1:
+        return
+    put(name, rdtype, time.time() + ttl, 'ANSWER', answer.response.to_wire())
+
+def put_error(name, rdtype, e):
+    """ Keeps an NXDOMAIN, no answer or SERVFAIL result for the negative TTL. Timeouts are not cached. """
+    if isinstance(e, dns.resolver.NXDOMAIN):
+        status = 'NXDOMAIN'
+    elif isinstance(e, dns.resolver.NoAnswer):
+        status = 'NOANSWER'
+    elif isinstance(e, dns.resolver.NoNameservers):
+        status = 'SERVFAIL'
+    else:
+        return
+    put(name, rdtype, time.time() + negative_ttl, status)
+
+def put(name, rdtype, expires_at, status, wire=None):
+    store(name, rdtype, expires_at, status, wire)
+    if shared:
+        item = {
+            'CacheKey': {'S': cache_key(name, rdtype)},
+            'Status': {'S': status},
+            'ExpiresAt': {'N': str(int(expires_at))}
+        }
+        if wire is not None:
+            item['Wire'] = {'B': wire}
+        pending.append(item)
+
+def prefetch(queries):
+    """ Loads fresh answers for (name, rdtype) pairs missing in memory from the shared table, 100 keys per call """
+    if not shared:
+        return
+    now = time.time()
+    keys = list(dict.fromkeys(
+        cache_key(name, rdtype) for name, rdtype in queries
+        if (normalize(name), rdtype) not in entries or entries[(normalize(name), rdtype)][0] <= now
+    ))
+    for i in range(0, len(keys), 100):
+        try:
+            response = aws.client('dynamodb').batch_get_item(RequestItems={
+                cache_id: {'Keys': [{'CacheKey': {'S': key}} for key in keys[i:i + 100]]}
+            })
+        except Exception as e: # Lookups go to DNS instead
+            print("Error reading shared DNS cache:", e)
+            return
+        for item in response['Responses'].get(cache_id, []):
+            expires_at = int(item['ExpiresAt']['N'])
+            if expires_at <= now:
+                continue
+            name, rdtype = item['CacheKey']['S'][len('dns-answer#'):].rsplit('#', 1)
+            store(name, rdtype, expires_at, item['Status']['S'], item['Wire']['B'] if 'Wire' in item else None)
+            counters['shared_hits'] += 1
+
+def flush():
+    """ Writes this batch's new answers to the shared table, 25 items per call """
+    items = list({item['CacheKey']['S']: item for item in pending}.values())
+    pending.clear()
+    for i in range(0, len(items), 25):
+        try:
+            aws.client('dynamodb').batch_write_item(RequestItems={
+                cache_id: [{'PutRequest': {'Item': item}} for item in items[i:i + 25]]
+            })
+        except Exception as e: # Other containers look the names up themselves
+            print("Error writing shared DNS cache:", e)
+
+def report():
+    """ Logs this invocation's hit rate """
+    hits, shared_hits, misses = counters['hits'], counters['shared_hits'], counters['misses']
+    counters.update({'hits': 0, 'shared_hits': 0, 'misses': 0})
+    if hits + misses:
+        print(f"DNS cache: {hits} hits ({shared_hits} loaded from the shared table), {misses} misses, {hits / (hits + misses):.0%} hit rate, {len(entries)} answers held")
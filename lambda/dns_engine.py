@@ -0,0 +1,76 @@
+import asyncio
+import os
+import time
+import dns.rdatatype
+import dns.resolver
+import dns_cache
+import dns_pool
+
+in_flight = int(os.environ.get('DNS_IN_FLIGHT', '64')) # Queries sent at once across the whole batch
+
+async def query(semaphore, name, rdtype):
+    """ Failover between upstreams happens in dns_pool, so errors are not retried here """
+    cached = dns_cache.get(name, rdtype)
+    if cached is not None:
+        return cached
+    try:
+        async with semaphore:
+            answer = await dns_pool.resolve(name, rdtype)
+    except Exception as e:
+        dns_cache.put_error(name, rdtype, e) # Timeouts are not kept
+        raise
+    dns_cache.put_answer(name, rdtype, answer)
+    return answer
+
+async def lookup(name, semaphore):
+    """ A (with its CNAME chain), AAAA and NS for one domain, sent together.
+    Returns {'dns_dict': ..., 'error': None, 'ms': ...}, or an error of "2" for NXDOMAIN and "5" for no A records,
+    as socket.gethostbyname_ex reported them before. """
+    start = time.perf_counter()
+    a, aaaa, ns = await asyncio.gather(
+        query(semaphore, name, 'A'),
+        query(semaphore, name, 'AAAA'),
+        query(semaphore, name, 'NS'),
+        return_exceptions=True
+    )
+    result = {'dns_dict': None, 'error': None, 'ns_error': None}
+    if isinstance(a, dns.resolver.NXDOMAIN):
+        result['error'] = "2"
+    elif isinstance(a, dns.resolver.NoAnswer):
+        result['error'] = "5"
+    elif isinstance(a, Exception):
+        result['error'] = str(a)
+    else:
+        other_ip_address = [i.to_text() for i in a]
+        if not isinstance(aaaa, Exception):
+            other_ip_address.extend(i.to_text() for i in aaaa)
+        result['dns_dict'] = {
+            'hostname': a.canonical_name.to_text(omit_final_dot=True),
+            'alias': [ # Names in the CNAME chain, like gethostbyname_ex's aliases
+                rrset.name.to_text(omit_final_dot=True) for rrset in a.response.answer if rrset.rdtype == dns.rdatatype.CNAME
+            ],
+            'other_ip_address': other_ip_address
+        }
+        if isinstance(ns, Exception):
+            result['ns_error'] = str(ns) or type(ns).__name__
+        else:
+            result['dns_dict']['nameservers'] = sorted([i.to_text() for i in ns])
+    result['ms'] = (time.perf_counter() - start) * 1000
+    return result
+
+async def lookup_all(names):
+    semaphore = asyncio.Semaphore(in_flight)
+    results = await asyncio.gather(*(lookup(name, semaphore) for name in names))
+    return dict(zip(names, results))
+
+def resolve_all(names):
+    """ Resolves every name at once. A batch takes about as long as its slowest lookup. Returns name -> result of lookup. """
+    names = list(dict.fromkeys(names)) # Rows of an upload often repeat a domain
+    if not names:
+        return {}
+    dns_cache.prefetch([(name, rdtype) for name in names for rdtype in ('A', 'AAAA', 'NS')])
+    results = asyncio.run(lookup_all(names))
+    dns_cache.flush()
+    dns_cache.report()
+    dns_pool.report()
+    return results
@@ -0,0 +1,120 @@
+import asyncio
+import os
+import random
+import time
+import dns.asyncquery
+import dns.exception
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.resolver
+
+hedge_ms = float(os.environ.get('DNS_HEDGE_MS', '200')) # A query still unanswered after this long is also sent to the next upstream
+timeout = float(os.environ.get('DNS_TIMEOUT', '3')) # Seconds per query across all upstreams tried
+explore = 0.05 # Share of queries sent first to a random upstream, so recovered upstreams are noticed
+
+class Upstream:
+    """ One resolver with moving averages of its latency and error rate """
+    def __init__(self, address):
+        if address.startswith('['): # [IPv6]:port
+            host, _, port = address[1:].partition(']:')
+        elif address.count(':') == 1: # IPv4:port
+            host, _, port = address.partition(':')
+        else:
+            host, port = address, ''
+        self.host = host
+        self.port = int(port or 53)
+        self.latency_ms = 50.0
+        self.error_rate = 0.0
+        self.queries = 0
+
+    def observe(self, elapsed_ms, error=None):
+        """ error None updates the latency only, for queries cancelled once another upstream answered """
+        self.latency_ms = 0.8 * self.latency_ms + 0.2 * elapsed_ms
+        if error is not None:
+            self.error_rate = 0.8 * self.error_rate + 0.2 * (1.0 if error else 0.0)
+            self.queries += 1
+
+    def score(self):
+        return self.latency_ms * (1 + 4 * self.error_rate)
+
+    def __str__(self):
+        return self.host if self.port == 53 else f"{self.host}:{self.port}"
+
+upstreams = [Upstream(address.strip()) for address in os.environ.get('UPSTREAMS', '1.1.1.1,8.8.8.8,9.9.9.9').split(',') if address.strip()]
+
+def best_first():
+    """ Healthy upstreams fastest first, then the unhealthy ones as a last resort """
+    return sorted(upstreams, key=lambda upstream: (upstream.error_rate >= 0.5, upstream.score()))
+
+def ranked():
+    order = best_first()
+    if len(order) > 1 and random.random() < explore:
+        order.insert(0, order.pop(random.randrange(1, len(order))))
+    return order
+
+async def ask(upstream, q):
+    start = time.perf_counter()
+    try:
+        response, _ = await dns.asyncquery.udp_with_fallback(q, upstream.host, timeout=timeout, port=upstream.port)
+    except asyncio.CancelledError:
+        upstream.observe((time.perf_counter() - start) * 1000)
+        raise
+    except Exception:
+        upstream.observe((time.perf_counter() - start) * 1000, True)
+        raise
+    upstream.observe((time.perf_counter() - start) * 1000, response.rcode() not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN))
+    return response
+
+def to_answer(qname, rdtype, response, upstream):
+    """ Raises NXDOMAIN and NoAnswer the same way dns.resolver does """
+    if response.rcode() == dns.rcode.NXDOMAIN:
+        raise dns.resolver.NXDOMAIN(qnames=[qname], responses={qname: response})
+    answer = dns.resolver.Answer(qname, rdtype, dns.rdataclass.IN, response, upstream.host, upstream.port)
+    if answer.rrset is None:
+        raise dns.resolver.NoAnswer(response=response)
+    return answer
+
+async def resolve(name, rdtype):
+    """ Sends the query to the best upstream. If it has not answered after DNS_HEDGE_MS, or fails, the next one is
+    asked too, and the first good answer wins. Raises NoNameservers if every upstream failed with SERVFAIL or REFUSED,
+    Timeout if none answered in time, or the network error. """
+    qname = dns.name.from_text(name)
+    rdtype = dns.rdatatype.from_text(rdtype)
+    q = dns.message.make_query(qname, rdtype)
+    order = ranked()
+    deadline = time.perf_counter() + timeout
+    tasks = {}
+    error = None
+    servfails = [] # (server, tcp, port, error, response), as dns.resolver reports them
+    try:
+        while True:
+            if order: # First upstream, a hedge once the delay passes without an answer, or a failover after an error
+                upstream = order.pop(0)
+                tasks[asyncio.ensure_future(ask(upstream, q))] = upstream
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                raise dns.exception.Timeout(timeout=timeout)
+            done, _ = await asyncio.wait(tasks, timeout=min(remaining, hedge_ms / 1000) if order else remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                upstream = tasks.pop(task)
+                if task.exception() is not None:
+                    error = error or task.exception()
+                elif task.result().rcode() in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+                    return to_answer(qname, rdtype, task.result(), upstream)
+                else: # SERVFAIL or REFUSED
+                    servfails.append((str(upstream), False, upstream.port, dns.rcode.to_text(task.result().rcode()), task.result()))
+                    error = dns.resolver.NoNameservers(request=q, errors=servfails)
+            if not tasks and not order:
+                raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+def report():
+    """ Logs each upstream's latency and error rate, best first """
+    print("DNS upstreams: " + ", ".join(
+        f"{upstream} {upstream.latency_ms:.0f} ms {upstream.error_rate:.0%} errors ({upstream.queries} queries)" for upstream in best_first()
+    ))
@@ -0,0 +1,58 @@
+import ipaddress
+import urllib.parse
+
+modules = { # Indicator types each enrichment module can handle. Other types are never sent to the module.
+    'vt': {'ipv4', 'ipv6', 'domain'},
+    'dns': {'domain'},
+    'whois': {'ipv4', 'ipv6', 'domain', 'url'},
+    'html': {'ipv4', 'ipv6', 'domain', 'url'},
+    'cert': {'domain'},
+    'hist': {'domain', 'url', 'apk'},
+    'ss': {'ipv4', 'ipv6', 'domain', 'url'}
+}
+
+skipped_status = '400' # Same status the modules write when they reject an input
+
+columns = { # Column each module reads the indicator from, for rows that have both. The first one present wins.
+    'dns': ('domain', 'ip_address'),
+    'whois': ('domain', 'ip_address'),
+    'cert': ('domain', 'ip_address')
+}
+default_columns = ('ip_address', 'domain')
+
+def module_columns(module):
+    return columns.get(module, default_columns)
+
+def module_indicator(module, values):
+    """ The value the module will look up, from {column: value} of a row, or None if the row has neither column """
+    return next((values[column] for column in module_columns(module) if column in values), None)
+
+def classify(ip_or_domain):
+    """ Returns one of ipv4, ipv6, domain, url or apk """
+    value = ip_or_domain.strip()
+    try:
+        address = ipaddress.ip_address(value.strip('[]'))
+        return 'ipv4' if address.version == 4 else 'ipv6'
+    except ValueError:
+        pass
+    parts = urllib.parse.urlsplit(value if '://' in value else '//' + value)
+    if parts.path.lower().endswith('.apk') or value.lower().endswith('.apk'): # Query strings after the file name are ignored
+        return 'apk'
+    if '://' in value or parts.path not in ('', '/') or parts.query:
+        return 'url'
+    return 'domain'
+
+def skipped_modules(values, statuses):
+    """ Modules that were requested for the row (status "0") but cannot handle the type of the indicator they would
+    read. values is {column: value} for the row's ip_address and domain columns. Returns {module: indicator type}. """
+    skipped = {}
+    for module, accepted in modules.items():
+        if statuses.get(f"{module}_status") != '0':
+            continue
+        value = module_indicator(module, values)
+        if value is None:
+            continue
+        indicator_type = classify(value)
+        if indicator_type not in accepted:
+            skipped[module] = indicator_type
+    return skipped
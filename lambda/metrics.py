@@ -0,0 +1,56 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+namespace = os.environ.get('METRICS_NAMESPACE', 'Enricher')
+
+class Timer:
+    """ Milliseconds spent in each stage (upstream, s3, dynamodb, cache, sleep, wait...) """
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock() # sns.py times its PublishBatch calls from several threads
+
+    def add(self, name, ms):
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0) + ms
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000)
+
+def outcome_of(status):
+    """ Short status codes such as 200, 404 or 2 are kept as they are. Other statuses are exception messages, and
+    each distinct dimension value is a separately billed metric, so they are all reported as "error". """
+    status = str(status)
+    return status if re.fullmatch(r'\d{1,3}', status) or status == 'none' else 'error'
+
+def emit(module, outcome, stages, counts=None):
+    """ Prints one CloudWatch Embedded Metric Format record. Lambda ships it to CloudWatch Logs, which turns it into
+    metrics named <stage>_ms with dimensions module and outcome. counts are extra metrics without a unit. """
+    values = {f"{name}_ms": round(ms, 3) for name, ms in stages.items()}
+    definitions = [{'Name': name, 'Unit': 'Milliseconds'} for name in values]
+    for name, count in (counts or {}).items():
+        values[name] = count
+        definitions.append({'Name': name, 'Unit': 'Count'})
+    record = {
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': namespace,
+                'Dimensions': [['module', 'outcome']],
+                'Metrics': definitions
+            }]
+        },
+        'module': module,
+        'outcome': str(outcome),
+        **values
+    }
+    sys.stdout.write(json.dumps(record) + '\n') # One write per record, so lines from different threads do not interleave
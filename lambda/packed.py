@@ -0,0 +1,115 @@
+import json
+import aws
+import os
+import threading
+
+s3_id = os.environ.get('S3_ID')
+enabled = os.environ.get('PACKED_OUTPUT', 'false').lower() == 'true' # Results are appended to segment files instead of one object each
+max_bytes = int(os.environ.get('PACKED_MAX_BYTES', str(64 * 1024 * 1024))) # Segments larger than this are written early and a new one started
+
+# Packed locations look like {s3_id}/{segment_key}#{offset},{length}. Each segment has an index at {segment_key}.index.json
+# listing the key each result would have had as a separate object, with its offset, length and content type.
+
+def location(bucket, key, offset=None, length=None):
+    if offset is None:
+        return f"{bucket}/{key}"
+    return f"{bucket}/{key}#{offset},{length}"
+
+def parse_location(file_location):
+    """ Returns (bucket, key, byte range or None) """
+    path, _, byte_range = file_location.partition('#')
+    bucket, _, key = path.partition('/')
+    if not byte_range:
+        return bucket, key, None
+    offset, length = (int(i) for i in byte_range.split(','))
+    return bucket, key, (offset, length)
+
+def read(file_location):
+    """ Fetches one result, with a ranged GET if it is stored in a segment """
+    bucket, key, byte_range = parse_location(file_location)
+    if byte_range is None:
+        return aws.client('s3').get_object(Bucket=bucket, Key=key)['Body'].read()
+    offset, length = byte_range
+    return aws.client('s3').get_object(
+        Bucket=bucket,
+        Key=key,
+        Range=f"bytes={offset}-{offset + length - 1}"
+    )['Body'].read()
+
+class Segment:
+    def __init__(self, key):
+        self.key = key
+        self.buffer = bytearray()
+        self.index = []
+        self.records = {} # message_id -> Record, for records with results in this segment
+
+    def write(self):
+        aws.client('s3').put_object(
+            Bucket=s3_id,
+            Key=self.key,
+            Body=bytes(self.buffer),
+            ContentType='application/octet-stream'
+        )
+        aws.client('s3').put_object(
+            Bucket=s3_id,
+            Key=f"{self.key}.index.json",
+            Body=json.dumps(self.index),
+            ContentType='application/json'
+        )
+
+class Packer:
+    """ Segments for one invocation of a module, one open segment per upload """
+    def __init__(self, module, request_id):
+        self.module = module
+        self.request_id = request_id
+        self.segments = {} # UploadFileName -> open Segment
+        self.sequence = 0
+        self.failed = [] # Records whose segment could not be written
+        self.lock = threading.Lock()
+
+    def new_segment(self, UploadFileName):
+        self.sequence += 1
+        return Segment(f"{UploadFileName}/{self.module}/packed/{self.request_id}-{self.sequence}.seg")
+
+    def put(self, record, Key, Body, ContentType=None):
+        """ Appends a result to the upload's segment and returns its packed location """
+        if isinstance(Body, str):
+            Body = Body.encode('utf-8')
+        full = None
+        with self.lock:
+            segment = self.segments.get(record.UploadFileName)
+            if segment is None:
+                segment = self.segments[record.UploadFileName] = self.new_segment(record.UploadFileName)
+            offset = len(segment.buffer)
+            segment.buffer += Body
+            segment.index.append({
+                'key': Key,
+                'offset': offset,
+                'length': len(Body),
+                'content_type': ContentType,
+                'TimeStamp': record.TimeStamp
+            })
+            segment.records[record.message_id] = record
+            if len(segment.buffer) >= max_bytes:
+                full = self.segments.pop(record.UploadFileName)
+        if full is not None:
+            self.write(full)
+        return location(s3_id, segment.key, offset, len(Body))
+
+    def write(self, segment):
+        try:
+            segment.write()
+            print(f"Packed {len(segment.index)} results into {s3_id}/{segment.key}")
+        except Exception as e:
+            print(f"Error writing segment {s3_id}/{segment.key}, {len(segment.records)} messages returned to queue \n {e}")
+            with self.lock:
+                self.failed.extend(segment.records.values())
+
+    def flush(self):
+        """ Writes the open segments. Returns the records whose results were lost. """
+        with self.lock:
+            segments = list(self.segments.values())
+            self.segments = {}
+        for segment in segments:
+            self.write(segment)
+        return self.failed
@@ -0,0 +1,49 @@
+import os
+import threading
+
+path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'public_suffix_list.dat') # Copy of https://publicsuffix.org/list/public_suffix_list.dat
+rules = set() # Rules as written in the list, e.g. "com", "*.ck", "!www.ck". Loaded on first use.
+rules_lock = threading.Lock()
+
+def load():
+    """ Reads the ICANN section only. Private suffixes (github.io, blogspot.com) have no WHOIS of their own,
+    so their subdomains collapse to the domain registered with the registry. """
+    with rules_lock:
+        if rules:
+            return
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line.startswith('// ===END ICANN DOMAINS==='):
+                    break
+                if line and not line.startswith('//'):
+                    rules.add(line.split()[0])
+
+def to_unicode(label):
+    """ The list writes internationalised suffixes in Unicode """
+    if label.startswith('xn--'):
+        try:
+            return label.encode('ascii').decode('idna')
+        except UnicodeError:
+            pass
+    return label
+
+def registrable_domain(name):
+    """ Returns the public suffix plus one label (eTLD+1), e.g. a.b.example.co.uk -> example.co.uk, lowercased
+    with punycode labels kept. Returns None if the name is itself a public suffix. """
+    if not rules:
+        load()
+    labels = name.strip().lower().rstrip('.').split('.')
+    unicode_labels = [to_unicode(label) for label in labels]
+    suffix_start = len(labels) - 1 # Unlisted TLDs count as public suffixes (the "*" rule)
+    for i in range(len(labels)): # Longest suffix first, so exception rules win over the wildcards they except
+        suffix = '.'.join(unicode_labels[i:])
+        if '!' + suffix in rules:
+            suffix_start = i + 1
+            break
+        if suffix in rules or (i + 1 < len(labels) and '*.' + '.'.join(unicode_labels[i + 1:]) in rules):
+            suffix_start = i
+            break
+    if suffix_start == 0:
+        return None
+    return '.'.join(labels[suffix_start - 1:])
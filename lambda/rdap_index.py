@@ -0,0 +1,99 @@
+import ipaddress
+import threading
+import time
+import cache
+
+max_entries = 20000 # Networks held per container
+neighbourhood = {4: 24, 6: 48} # Prefix length rows share a lookup lock at, see whois_code
+prefix_lengths = {4: (8, 24), 6: (19, 48)} # asn_cidr lengths indexed, as announced on the internet. Others are not kept, so each IP needs at most 17 or 30 keys.
+
+networks = {} # ip_network -> (expires_at, info). Lives across warm invocations.
+lock = threading.Lock() # Worker threads match and store concurrently, also guards counters
+counters = {'hits': 0, 'misses': 0}
+
+def prefixes(ip):
+    """ Networks of an indexed length containing the IP, longest prefix first """
+    address = ipaddress.ip_address(ip)
+    shortest, longest = prefix_lengths[address.version]
+    return [ipaddress.ip_network(f"{address}/{length}", strict=False) for length in range(longest, shortest - 1, -1)]
+
+def store(network, expires_at, info):
+    with lock:
+        if len(networks) >= max_entries:
+            now = time.time()
+            for key in [key for key, entry in networks.items() if entry[0] <= now]:
+                del networks[key]
+            while len(networks) >= max_entries: # Oldest first
+                del networks[next(iter(networks))]
+        networks[network] = (expires_at, info)
+
+def prefetch(ips):
+    """ Loads the cached networks containing any of the IPs into memory, reading every prefix length of every IP
+    in as few BatchGetItem calls as possible """
+    candidates = set()
+    for ip in ips:
+        try:
+            if match(ip, count=False) is None:
+                candidates.update(prefixes(ip))
+        except ValueError:
+            continue
+    if not candidates:
+        return
+    try:
+        items = cache.get_many('rdap', [network.with_prefixlen for network in candidates])
+    except Exception as e: # Lookups go to RDAP instead
+        print("Error reading RDAP network cache:", e)
+        return
+    for value, item in items.items():
+        store(ipaddress.ip_network(value), int(item['ExpiresAt']), item['Info'])
+
+def match(ip, count=True):
+    """ Returns (network, info) for the longest fresh cached network containing the IP, or None """
+    now = time.time()
+    found = None
+    for network in prefixes(ip):
+        entry = networks.get(network)
+        if entry is not None and entry[0] > now:
+            found = (network, entry[1])
+            break
+    if count:
+        with lock:
+            counters['hits' if found else 'misses'] += 1
+    return found
+
+def put(ip, info, cached_at=None):
+    """ Indexes a successful lookup under its asn_cidr. Ranges that do not contain the IP, or of a length outside
+    prefix_lengths, are ignored. cached_at is when info was looked up, for results that came from the cache table,
+    so the network expires with the data rather than a full TTL after the copy. """
+    address = ipaddress.ip_address(ip)
+    cached_at = int(cached_at or time.time())
+    expires_at = cached_at + cache.ttl('rdap')
+    if expires_at <= time.time():
+        return
+    for cidr in str(info.get('asn_cidr') or '').split(','): # Occasionally several ranges, comma separated
+        try:
+            network = ipaddress.ip_network(cidr.strip(), strict=False)
+        except ValueError: # 'NA' when Team Cymru has no range
+            continue
+        shortest, longest = prefix_lengths[network.version]
+        if network.version != address.version or address not in network or not shortest <= network.prefixlen <= longest:
+            continue
+        store(network, expires_at, info)
+        try:
+            cache.put('rdap', network.with_prefixlen, '200', info, cached_at)
+        except Exception as e: # Only this container's index has the range
+            print("Error writing RDAP network cache:", e)
+
+def lock_key(ip):
+    """ Rows of IPs this close together usually share a network, so they wait for one lookup instead of racing """
+    address = ipaddress.ip_address(ip)
+    return ipaddress.ip_network(f"{address}/{neighbourhood[address.version]}", strict=False).with_prefixlen
+
+def report():
+    """ Logs this invocation's hit rate """
+    with lock:
+        hits, misses = counters['hits'], counters['misses']
+        counters.update({'hits': 0, 'misses': 0})
+        held = len(networks)
+    if hits + misses:
+        print(f"RDAP network index: {hits} hits, {misses} misses, {held} networks held")
@@ -1,67 +1,166 @@
 import json
 import boto3
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import indicator
+import metrics
 
 topic_arn = os.environ['TOPIC_ARN']
+db_id = os.environ['DB_ID']
+publish_workers = int(os.environ.get('PUBLISH_WORKERS', '8')) # Number of PublishBatch calls in flight at once
+
+batch_size = 10 # Maximum number of entries per PublishBatch call
+trace_fields = ('TraceId', 'IngestedAt') # Sent in the message body instead, as SNS allows only 10 message attributes
+priorities = ('high', 'normal', 'low') # VT queue a row goes to, from the upload's priority metadata
 
 client = boto3.client('sns')
+dynamodb = boto3.client('dynamodb') # Low-level client is thread safe, unlike the Table resource
 
-def lambda_handler(event, context):
-    for record in event['Records']:
-        if record['eventName'] == 'INSERT':
-            UploadFileName = record['dynamodb']['NewImage']['UploadFileName']['S']
-            TimeStamp = record['dynamodb']['NewImage']['TimeStamp']['S']
-            # print(record['dynamodb']['NewImage'])
+def normalize_priority(value):
+    value = (value or '').strip().lower()
+    return value if value in priorities else 'normal'
+
+def to_message_attributes(new_image):
+    """ Convert DynamoDB image format to SNS MessageAttributes format """
+    message_attributes = {
+        'priority': { # Always set, since the VT queues' filter policies match on it
+            'DataType': 'String',
+            'StringValue': normalize_priority(new_image.get('priority', {}).get('S'))
+        }
+    }
+    for key, value in new_image.items():
+        if key in trace_fields or key == 'priority':
+            continue
+        if key.endswith('_status') and value.get('S') != '0': # No subscription matches them, and SNS allows only 10 message attributes
+            continue
+        if 'S' in value: # String
+            if value['S'].strip():
+                message_attributes[key] = {
+                    'DataType': 'String',
+                    'StringValue': value['S']
+                }
+            else:
+                pass
+        # elif 'M' in value: # Map # No longer relevant due to changes in DynamoDB table structure
+        #     for subkey, subvalue in value['M'].items():
+        #         if 'S' in subvalue: # String (Unlikely to show up, but just in case)
+        #             message_attributes[subkey] = {
+        #                 'DataType': 'String',
+        #                 'StringValue': subvalue['S']
+        #             }
+        #         elif 'N' in subvalue: # Integer
+        #             message_attributes[subkey] = {
+        #                 'DataType': 'Number',
+        #                 'StringValue': subvalue['N']
+        #             }
+        #         # Other data types should not show up
+        elif 'N' in value: # Integer (Unlikely to show up, but just in case)
+            if value['N'].strip():
+                message_attributes[key] = {
+                    'DataType': 'Number',
+                    'StringValue': value['N']
+                }
+            else:
+                pass
+        # Other data types should not show up
+    return message_attributes
+
+def trace_context(record):
+    """ Hop timestamps (ms) so far: row written by csv_code, change seen by the stream, message published """
+    new_image = record['dynamodb']['NewImage']
+    trace = {
+        'id': new_image.get('TraceId', {}).get('S'),
+        'ingested': int(new_image['IngestedAt']['S']) if 'IngestedAt' in new_image else None,
+        'stream': int(float(record['dynamodb']['ApproximateCreationDateTime']) * 1000) if 'ApproximateCreationDateTime' in record['dynamodb'] else None,
+        'published': int(time.time() * 1000)
+    }
+    return {hop: value for hop, value in trace.items() if value is not None}
+
+def route(new_image, message_attributes):
+    """ Removes modules that cannot handle the indicator type from the message, so their queues never receive it.
+    Their statuses are written in a single update. Returns False if no module is left to publish to. """
+    values = {column: new_image[column].get('S', '') for column in ('ip_address', 'domain') if column in new_image}
+    statuses = {key: value['StringValue'] for key, value in message_attributes.items()}
+    skipped = indicator.skipped_modules(values, statuses) # Each module by the column it reads, so dns still gets the domain of a row that also has an IP
+    if not skipped:
+        return True
 
-            """ Convert DynamoDB image format to SNS MessageAttributes format """
-            message_attributes = {}
-            for key, value in record['dynamodb']['NewImage'].items():
-                if 'S' in value: # String
-                    if value['S'].strip():
-                        message_attributes[key] = {
-                            'DataType': 'String',
-                            'StringValue': value['S']
-                        }
-                    else:
-                        pass
-                # elif 'M' in value: # Map # No longer relevant due to changes in DynamoDB table structure
-                #     for subkey, subvalue in value['M'].items():
-                #         if 'S' in subvalue: # String (Unlikely to show up, but just in case)
-                #             message_attributes[subkey] = {
-                #                 'DataType': 'String',
-                #                 'StringValue': subvalue['S']
-                #             }
-                #         elif 'N' in subvalue: # Integer
-                #             message_attributes[subkey] = {
-                #                 'DataType': 'Number',
-                #                 'StringValue': subvalue['N']
-                #             }
-                #         # Other data types should not show up
-                elif 'N' in value: # Integer (Unlikely to show up, but just in case)
-                    if value['N'].strip():
-                        message_attributes[key] = {
-                            'DataType': 'Number',
-                            'StringValue': value['N']
-                        }
-                    else:
-                        pass
-                # Other data types should not show up
-            
-            # print(message_attributes)
+    dynamodb.update_item(
+        TableName=db_id,
+        Key={
+            'UploadFileName': new_image['UploadFileName'],
+            'TimeStamp': new_image['TimeStamp']
+        },
+        UpdateExpression="SET " + ", ".join(f"{module}_status = :skipped" for module in skipped),
+        ExpressionAttributeValues={
+            ':skipped': {'S': indicator.skipped_status}
+        }
+    )
+    for module in skipped:
+        del message_attributes[f"{module}_status"]
+    print(f"Skipped for {values}: {', '.join(f'{module} ({indicator_type})' for module, indicator_type in skipped.items())}")
+    return any(value['StringValue'] == '0' for key, value in message_attributes.items() if key.endswith('_status'))
 
-            """ Publish message to SNS topic """
-            try:
-                response = client.publish(
-                    TopicArn = topic_arn,
-                    Message = f"New file uploaded: {UploadFileName}---{TimeStamp}",
-                    MessageAttributes = message_attributes
-                )
-                print("Message published:", response)
-            except Exception as e:
-                print("Error publishing message:", e)
+def publish_batch(records, timer):
+    """ Publishes up to 10 records in one call. Returns the sequence numbers of records that should be retried. """
+    entries = []
+    retry = []
+    for i, record in enumerate(records):
+        new_image = record['dynamodb']['NewImage']
+        UploadFileName = new_image['UploadFileName']['S']
+        TimeStamp = new_image['TimeStamp']['S']
+        message_attributes = to_message_attributes(new_image)
+        try:
+            with timer.stage('dynamodb'):
+                routed = route(new_image, message_attributes)
+            if not routed:
                 continue
+        except Exception as e:
+            print(f"Error routing message: {UploadFileName}---{TimeStamp} \n {e}")
+            retry.append(record['dynamodb']['SequenceNumber'])
+            continue
+        entries.append({
+            'Id': str(i), # Position in the batch, used to map failures back to records
+            'Message': json.dumps({
+                'message': f"New file uploaded: {UploadFileName}---{TimeStamp}",
+                'trace': trace_context(record)
+            }),
+            'MessageAttributes': message_attributes
+        })
+
+    if not entries:
+        return retry
+
+    try:
+        with timer.stage('sns'):
+            response = client.publish_batch(
+                TopicArn=topic_arn,
+                PublishBatchRequestEntries=entries
+            )
+    except Exception as e:
+        print("Error publishing batch:", e)
+        return retry + [records[int(entry['Id'])]['dynamodb']['SequenceNumber'] for entry in entries]
+
+    messages = {entry['Id']: json.loads(entry['Message'])['message'] for entry in entries}
+    for failed in response.get('Failed', []):
+        record = records[int(failed['Id'])]
+        print(f"Error publishing message: {messages[failed['Id']]} \n {failed.get('Code')}: {failed.get('Message')}")
+        if not failed.get('SenderFault'): # Malformed messages would fail again, so they are dropped as before
+            retry.append(record['dynamodb']['SequenceNumber'])
+    return retry
+
+def lambda_handler(event, context):
+    records = [record for record in event['Records'] if record['eventName'] == 'INSERT']
+    batches = [records[i:i + batch_size] for i in range(0, len(records), batch_size)]
+
+    """ Publish messages to SNS topic """
+    timer = metrics.Timer()
+    with timer.stage('total'), ThreadPoolExecutor(max_workers=publish_workers) as executor:
+        failed = [sequence_number for retry in executor.map(lambda batch: publish_batch(batch, timer), batches) for sequence_number in retry]
+    print(f"Messages published: {len(records) - len(failed)} of {len(records)}")
+    metrics.emit('sns', 'partial' if failed else 'ok', timer.stages, {'records': len(records), 'failed': len(failed)}) # dynamodb and sns stages are summed over the publishing threads
 
-    return {
-        'statusCode': 200,
-        'body': json.dumps('Message sent to SNS')
+    return { # Only failed records (and those after them in the shard) are retried
+        'batchItemFailures': [{'itemIdentifier': sequence_number} for sequence_number in failed]
     }
@@ -0,0 +1,111 @@
+import urllib.parse
+import boto3
+import json
+import os
+import metrics
+
+csv_function_id = os.environ['CSV_FUNCTION_ID']
+split_bytes = int(os.environ.get('SPLIT_BYTES', str(32 * 1024 * 1024))) # Target size of each byte range handed to a csv_code worker
+max_parts = int(os.environ.get('MAX_PARTS', '50'))
+
+probe_bytes = 64 * 1024 # Size of each ranged GET used to look for the end of a line
+
+s3 = boto3.client('s3')
+lambda_client = boto3.client('lambda')
+
+def find_line_end(bucket, key, version_id, start, size):
+    """ Returns the offset just after the first newline at or after start """
+    while start < size:
+        end = min(start + probe_bytes, size)
+        request = {'Bucket': bucket, 'Key': key, 'Range': f"bytes={start}-{end - 1}"}
+        if version_id:
+            request['VersionId'] = version_id
+        chunk = s3.get_object(**request)['Body'].read()
+        index = chunk.find(b'\n')
+        if index != -1:
+            return start + index + 1
+        start = end
+    return size
+
+def has_quoted_newline(bucket, key, version_id, offset, size):
+    """ Whether a full line in the probe window around offset has an odd number of double quotes, i.e. opens or closes
+    a quoted field that continues on another line. Cutting the file near there would split that field. """
+    start = max(0, offset - probe_bytes // 2)
+    request = {'Bucket': bucket, 'Key': key, 'Range': f"bytes={start}-{min(offset + probe_bytes // 2, size) - 1}"}
+    if version_id:
+        request['VersionId'] = version_id
+    lines = s3.get_object(**request)['Body'].read().split(b'\n')
+    if start > 0:
+        lines = lines[1:] # Partial first line
+    return any(line.count(b'"') % 2 for line in lines[:-1]) # Last line may be partial too
+
+def split_ranges(bucket, key, version_id, size):
+    """ Cuts the object after the header row into byte ranges that start and end on line boundaries. Returns
+    (None, [None]) when the file should be ingested whole instead. Quoted fields with line breaks are only noticed if
+    the lines that open or close them fall in a probe window around a cut; a cut between two middle lines of a very
+    long multi-line field is not detected, and such files should be uploaded below SPLIT_BYTES or compressed. """
+    header_end = find_line_end(bucket, key, version_id, 0, size)
+    parts = min(max_parts, max(1, -(-(size - header_end) // split_bytes)))
+    boundaries = [header_end]
+    for i in range(1, parts):
+        nominal = header_end + i * (size - header_end) // parts
+        boundary = find_line_end(bucket, key, version_id, max(nominal, boundaries[-1]), size)
+        if boundary < size and boundary > boundaries[-1]:
+            if has_quoted_newline(bucket, key, version_id, boundary, size):
+                print(f"Quoted field with a line break near byte {boundary}, ingesting s3://{bucket}/{key} in one part")
+                return None, [None]
+            boundaries.append(boundary)
+    if len(boundaries) == 1: # Nothing after the header, or too little to cut
+        return None, [None]
+    boundaries.append(size)
+    return header_end, list(zip(boundaries[:-1], boundaries[1:]))
+
+def lambda_handler(event, context):
+    for record in event['Records']:
+        bucket = record['s3']['bucket']['name']
+        key = urllib.parse.unquote_plus(record['s3']['object']['key'])
+        print(f"New file uploaded: s3://{bucket}/{key}")
+
+        timer = metrics.Timer()
+        with timer.stage('head'):
+            head = s3.head_object(Bucket=bucket, Key=key)
+        size = head['ContentLength']
+        version_id = head.get('VersionId')
+
+        if size <= split_bytes or not key.endswith('.csv'): # Small uploads, and compressed or Parquet ones that cannot be cut into byte ranges, are ingested whole by a single worker
+            header = None
+            ranges = [None]
+        else:
+            with timer.stage('probe'): # Ranged GETs looking for line boundaries, and the header row
+                header_end, ranges = split_ranges(bucket, key, version_id, size)
+                header = None
+                if header_end is not None:
+                    request = {'Bucket': bucket, 'Key': key, 'Range': f"bytes=0-{header_end - 1}"}
+                    if version_id:
+                        request['VersionId'] = version_id
+                    header = s3.get_object(**request)['Body'].read().decode('utf-8-sig').rstrip('\r\n')
+
+        for part, byte_range in enumerate(ranges):
+            with timer.stage('invoke'):
+                response = lambda_client.invoke(
+                    FunctionName=csv_function_id,
+                    InvocationType='Event',
+                    Payload=json.dumps({
+                        'split': {
+                            'bucket': bucket,
+                            'key': key,
+                            'version_id': version_id,
+                            'range': byte_range,
+                            'header': header,
+                            'part': part,
+                            'parts': len(ranges)
+                        }
+                    })
+                )
+        print(f"Split s3://{bucket}/{key} ({size} bytes) into {len(ranges)} parts")
+        metrics.emit('split', 'ok', timer.stages, {'parts': len(ranges), 'bytes': size})
+
+    return {
+        'statusCode': 200,
+        'body': 'CSV split for ingestion'
+    }
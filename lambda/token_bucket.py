@@ -0,0 +1,93 @@
+import datetime
+import os
+import random
+import time
+import aws
+
+quota_id = os.environ.get('QUOTA_ID') # Rate limiting is skipped if the function has no quota table
+
+class QuotaExhausted(Exception):
+    """ The daily allowance is used up until the next UTC day """
+
+class TokenBucket:
+    """ Token bucket shared by every invocation through one DynamoDB item, plus a counter for each UTC day.
+    Tokens are refilled at rate_per_minute up to burst. A token is only taken if the bucket item is unchanged since it
+    was read and the day's count is below daily_quota, in a single transaction, so concurrent invocations never
+    take more than the allowance between them. """
+    def __init__(self, name, rate_per_minute, daily_quota=None, burst=1):
+        self.name = name
+        self.rate = rate_per_minute / 60 # Tokens per second
+        self.daily_quota = daily_quota
+        self.burst = burst # 1 spaces calls evenly, so no 60 second window ever holds more than rate_per_minute of them
+
+    def day_key(self, now):
+        return f"{self.name}#{datetime.datetime.fromtimestamp(now, datetime.timezone.utc).strftime('%Y-%m-%d')}"
+
+    def used_today(self):
+        """ Tokens taken so far on the current UTC day """
+        item = aws.client('dynamodb').get_item(
+            TableName=quota_id,
+            Key={'BucketKey': {'S': self.day_key(time.time())}},
+            ConsistentRead=True
+        ).get('Item')
+        return int(item['Used']['N']) if item else 0
+
+    def try_acquire(self):
+        """ Takes a token. Returns 0 if it was taken, otherwise the seconds to wait before trying again. """
+        now = time.time()
+        item = aws.client('dynamodb').get_item(
+            TableName=quota_id,
+            Key={'BucketKey': {'S': self.name}},
+            ConsistentRead=True
+        ).get('Item')
+        bucket_update = {
+            'TableName': quota_id,
+            'Key': {'BucketKey': {'S': self.name}},
+            'UpdateExpression': 'SET Tokens = :tokens, RefilledAt = :now',
+            'ExpressionAttributeValues': {':now': {'N': f"{now:.6f}"}}
+        }
+        if item is None:
+            tokens = self.burst
+            bucket_update['ConditionExpression'] = 'attribute_not_exists(RefilledAt)'
+        else:
+            tokens = min(self.burst, float(item['Tokens']['N']) + (now - float(item['RefilledAt']['N'])) * self.rate)
+            bucket_update['ConditionExpression'] = 'RefilledAt = :refilled'
+            bucket_update['ExpressionAttributeValues'][':refilled'] = item['RefilledAt']
+        if tokens < 1:
+            return (1 - tokens) / self.rate
+        bucket_update['ExpressionAttributeValues'][':tokens'] = {'N': f"{tokens - 1:.6f}"}
+
+        items = [{'Update': bucket_update}]
+        if self.daily_quota is not None:
+            items.append({'Update': {
+                'TableName': quota_id,
+                'Key': {'BucketKey': {'S': self.day_key(now)}},
+                'UpdateExpression': 'ADD Used :one SET ExpiresAt = :expires',
+                'ConditionExpression': 'attribute_not_exists(Used) OR Used < :quota',
+                'ExpressionAttributeValues': {
+                    ':one': {'N': '1'},
+                    ':quota': {'N': str(self.daily_quota)},
+                    ':expires': {'N': str(int(now) + 2 * 86400)} # Kept a day after it ends, then removed by DynamoDB TTL
+                }
+            }})
+        try:
+            aws.client('dynamodb').transact_write_items(TransactItems=items)
+        except aws.client('dynamodb').exceptions.TransactionCanceledException as e:
+            reasons = e.response.get('CancellationReasons', [])
+            if len(reasons) > 1 and reasons[1].get('Code') == 'ConditionalCheckFailed':
+                raise QuotaExhausted(f"{self.name} daily quota of {self.daily_quota} used up")
+            return random.uniform(0.05, 0.2) # Another invocation took a token first, or the transaction conflicted
+        return 0
+
+    def acquire(self, max_wait):
+        """ Waits up to max_wait seconds for a token. Returns True once taken, False if none was free in time. """
+        if not quota_id:
+            return True
+        deadline = time.time() + max_wait
+        while True:
+            wait = self.try_acquire()
+            if wait == 0:
+                return True
+            if time.time() + wait > deadline:
+                return False
+            time.sleep(wait)
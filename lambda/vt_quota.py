@@ -1,25 +1,142 @@
-import boto3
+import json
 import os
+import time
+import aws
+import metrics
+import token_bucket
 
-lambda_client = boto3.client('lambda')
-uuid = "XXXXXX" # NEED TO UPDATE
+vt_function_id = os.environ['VT_FUNCTION_ID']
+queues = json.loads(os.environ['QUEUES']) # {"high": {"url": ..., "arn": ...}, "normal": ..., "low": ...}
+rate_per_minute = int(os.environ.get('VT_RATE_PER_MINUTE', '4'))
+daily_quota = int(os.environ.get('VT_DAILY_QUOTA', '500'))
+high_reserve = int(os.environ.get('VT_HIGH_RESERVE', str(daily_quota // 10))) # Lookups each day that only high priority messages may use
+weights = json.loads(os.environ.get('VT_PRIORITY_WEIGHTS', '{"normal": 3, "low": 1}')) # Share of the rest of each minute's lookups
+run_seconds = 50 # Stops pulling before the next scheduled run. The function timeout in enricher_cdk_stack.py allows for one VT request past this.
+retry_seconds = 60 # Failed messages wait for the next run, so a message that always fails does not take another token this minute
 
-def lambda_handler(event, source):
-    if "eventbridge" in event:
-        trigger = "eventbridge"
-        response = lambda_client.update_event_source_mapping(
-            UUID=uuid,
-            Enabled=True
+bucket = token_bucket.TokenBucket('vt', rate_per_minute, daily_quota) # Same bucket vt.py takes its tokens from
+
+def receive(priority, count):
+    """ Pulls up to count messages from the priority's VT queue, as the records of an SQS event """
+    messages = []
+    while len(messages) < count:
+        response = aws.client('sqs').receive_message(
+            QueueUrl=queues[priority]['url'],
+            MaxNumberOfMessages=min(10, count - len(messages)), # Maximum of 10 messages per call
+            WaitTimeSeconds=0 if messages else 1,
+            AttributeNames=['All']
         )
-        print("VT function enabled")
-    else:
-        trigger = "lambda"
-        response = lambda_client.update_event_source_mapping(
-            UUID=uuid,
-            Enabled=False
+        if not response.get('Messages'):
+            break
+        messages.extend(response['Messages'])
+    return [
+        {
+            'messageId': message['MessageId'],
+            'receiptHandle': message['ReceiptHandle'],
+            'body': message['Body'],
+            'attributes': message.get('Attributes', {}),
+            'messageAttributes': {},
+            'md5OfBody': message['MD5OfBody'],
+            'eventSource': 'aws:sqs',
+            'eventSourceARN': queues[priority]['arn'],
+            'awsRegion': queues[priority]['arn'].split(':')[3]
+        }
+        for message in messages
+    ]
+
+def in_batches(action, records, **kwargs):
+    """ Calls a batch SQS action (delete_message_batch, change_message_visibility_batch) 10 records of a queue at a time """
+    urls = {queue['arn']: queue['url'] for queue in queues.values()}
+    batches = {}
+    for record in records:
+        batches.setdefault(record['eventSourceARN'], []).append(record)
+    for arn, queue_records in batches.items():
+        for i in range(0, len(queue_records), 10):
+            send_batch(action, urls[arn], queue_records[i:i + 10], **kwargs)
+
+def send_batch(action, url, batch, **kwargs):
+    response = getattr(aws.client('sqs'), action)(
+        QueueUrl=url,
+        Entries=[
+            {'Id': str(j), 'ReceiptHandle': record['receiptHandle'], **kwargs}
+            for j, record in enumerate(batch)
+        ]
+    )
+    for failed in response.get('Failed', []):
+        print(f"Error in {action} for message {batch[int(failed['Id'])]['messageId']}: {failed.get('Message')}")
+
+def split(count):
+    """ Divides count between normal and low priority by weight, rounding in favour of the heavier lane """
+    lanes = sorted(weights, key=weights.get, reverse=True)
+    total = sum(weights.values())
+    shares = {lane: count * weights[lane] // total for lane in lanes}
+    for lane in lanes[:count - sum(shares.values())]:
+        shares[lane] += 1
+    return shares
+
+def receive_shared(count):
+    """ Pulls count messages from the normal and low queues by weight. A lane with fewer messages than its share
+    leaves the rest to the other. """
+    shares = split(count)
+    records = []
+    carry = 0
+    for lane in list(shares) + list(shares)[:1]: # Second pass over the heavier lane picks up what the lighter one left
+        wanted = shares.pop(lane, 0) + carry
+        if wanted <= 0:
+            continue
+        pulled = receive(lane, wanted)
+        carry = wanted - len(pulled)
+        records.extend(pulled)
+    return records
+
+def run_vt(records, timer):
+    """ Invokes the VT Lambda with the records as an SQS event. Deletes the messages it processed and makes the rest
+    visible again for the next run. Each pull counts towards the queue's dead-letter max receive count. """
+    with timer.stage('invoke'):
+        response = aws.client('lambda').invoke(
+            FunctionName=vt_function_id,
+            InvocationType='RequestResponse',
+            Payload=json.dumps({'Records': records})
         )
-        print("VT function disabled")
-    print(response)
+    result = json.loads(response['Payload'].read() or 'null')
+    if response.get('FunctionError'):
+        print(f"VT function failed, {len(records)} messages returned to queue \n {result}")
+        failed = {record['messageId'] for record in records}
+    else:
+        failed = {failure['itemIdentifier'] for failure in result.get('batchItemFailures', [])}
+    with timer.stage('delete'): # Includes returning the failed messages
+        in_batches('delete_message_batch', [record for record in records if record['messageId'] not in failed])
+        in_batches('change_message_visibility_batch', [record for record in records if record['messageId'] in failed], VisibilityTimeout=retry_seconds)
+    return len(records) - len(failed)
+
+def lambda_handler(event, context):
+    """ Runs every minute. Pulls as many VT messages as there are VT lookups left this minute and today, so the
+    function never runs past the quota. Once the daily quota is used, messages wait in the queue until the next UTC day.
+    High priority messages are pulled first. Normal and low priority share what is left by weight, and cannot use the
+    last VT_HIGH_RESERVE lookups of the day. """
+    deadline = time.time() + run_seconds
+    timer = metrics.Timer()
+    used_at_start = bucket.used_today()
+    pulled = processed = 0
+    while time.time() < deadline:
+        used = bucket.used_today()
+        if used >= daily_quota:
+            print(f"VT daily quota of {daily_quota} used, resuming after 00:00 UTC")
+            break
+        budget = min(rate_per_minute - max(used - used_at_start, 0), daily_quota - used) # Cache hits take no tokens, so pulls continue until this minute's tokens are used
+        if budget <= 0:
+            break
+        with timer.stage('receive'):
+            records = receive('high', budget) # High priority always goes first
+            shared = min(budget - len(records), daily_quota - high_reserve - used)
+            if shared > 0:
+                records.extend(receive_shared(shared))
+        if not records:
+            break
+        pulled += len(records)
+        processed += run_vt(records, timer)
+    print(f"VT messages pulled: {pulled}, processed: {processed}, quota used today: {bucket.used_today()} of {daily_quota}")
+    metrics.emit('vt_quota', 'partial' if processed < pulled else 'ok', timer.stages, {'pulled': pulled, 'processed': processed})
     return {
         'statusCode': 200
     }
@@ -1,19 +1,17 @@
 import json
-import urllib
-import boto3
-import whois
-import ipwhois
+import threading
+import urllib.parse
 from datetime import datetime
 from slugify import slugify
-import os
-import time
+import psl
+import rdap_index
+from worker import Worker
 
-db_id = os.environ["DB_ID"]
-s3_id = os.environ['S3_ID']
+worker = Worker('whois')
 
-s3 = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb')
-table = dynamodb.Table(db_id)
+results = {} # Registrable domain -> (status, info) written for the first of its rows in this invocation
+locks = {} # Registrable domain or IP neighbourhood -> lock held while its first row is looked up
+locks_lock = threading.Lock()
 
 def serialize_datetimes(w): # Recursive function to serialise w
     if isinstance(w, dict):
@@ -27,140 +25,143 @@ def serialize_datetimes(w): # Recursive function to serialise w
     else:
         return w
 
-def update_error(UploadFileName, TimeStamp, e, log_info):
-    table.update_item(
-        Key={
-            'UploadFileName': UploadFileName,
-            'TimeStamp': TimeStamp
-        },
-        UpdateExpression='SET whois_status = :status, whois_info = :info',
-        ExpressionAttributeValues={
-            ':status': str(e),
-            ':info': {
-                "whois_log_info": log_info
-            }
-        }
-    )
+def registrable_domain(record):
+    """ Domain the registry holds the WHOIS record for, e.g. example.co.uk for www.shop.example.co.uk """
+    if record.indicator_type == 'url':
+        host = urllib.parse.urlsplit(record.ip_or_domain if '://' in record.ip_or_domain else '//' + record.ip_or_domain).hostname
+    elif record.indicator_type == 'domain':
+        host = record.ip_or_domain
+    else:
+        return record.ip_or_domain
+    return psl.registrable_domain(host or record.ip_or_domain) or record.ip_or_domain
 
-def lambda_handler(event, context):
-    log_info = {
-        'log_stream_name': context.log_stream_name,
-        'log_group_name': context.log_group_name,
-        'aws_request_id': context.aws_request_id
-    }
-    for record in event['Records']: # If there are five messages in one batch, there will be five records.
-        """ Parses records from SQS event trigger """
-        sqs_payload = json.loads(record['body'])
-        new_image = sqs_payload.get('MessageAttributes')
-        UploadFileName = new_image['UploadFileName']['Value']
-        TimeStamp = new_image['TimeStamp']['Value']
-        
-        if 'ip_address' in new_image:
-            ip_or_domain = new_image['ip_address']['Value']
-        elif 'domain' in new_image:
-            ip_or_domain = new_image['domain']['Value']
-        else:
-            print(f"No IP or domain found for {UploadFileName}---{TimeStamp}")
-            continue
-
-        txt_filename = slugify(ip_or_domain) + '_' + TimeStamp
-        
-        print(f"Starting WHOIS for {ip_or_domain}")
-        current_time = time.time()
-        if 'domain' in new_image:
-            ip_or_domain = new_image['domain']['Value']
-            try:
-                w = whois.whois(ip_or_domain)
-                if w is None:
-                    raise Exception("499")
-                elif w.domain_name is None:
-                    raise Exception("400")
-                else:
-                    body=serialize_datetimes(w) # Need to make dates JSON compatible for json.dumps() later
-            except Exception as e:
-                print(f"WHOIS failed for {ip_or_domain} - {UploadFileName}---{TimeStamp} \n {e}")
-                log_info['duration'] = int(time.time() - current_time)
-                if "No match for" in str(e):
-                    update_error(UploadFileName, TimeStamp, "400", log_info)
-                else:
-                    update_error(UploadFileName, TimeStamp, e, log_info)
-                continue
-        elif 'ip_address' in new_image:
-            ip_or_domain = new_image['ip_address']['Value']
-            try:
+def lock_for(key):
+    with locks_lock:
+        return locks.setdefault(key, threading.Lock())
+
+def prepare(records, context):
+    """ Loads the cached networks of the batch's IP addresses in one go """
+    rdap_index.prefetch([record.ip_or_domain for record in records if record.field == 'ip_address'])
+
+def process_ip(record):
+    """ IPs inside a network already looked up are answered from the network's result """
+    try:
+        key = rdap_index.lock_key(record.ip_or_domain)
+    except ValueError: # Not an IP address, RDAP reports the error
+        lookup(record)
+        return
+    with lock_for(key): # Nearby IPs wait for the first one's lookup, which usually covers them
+        with record.stage('cache'):
+            found = rdap_index.match(record.ip_or_domain)
+        if found is None:
+            lookup(record)
+            if record.outcome == '200':
+                with record.stage('cache'):
+                    rdap_index.put(record.ip_or_domain, record.info, record.log_info.get('cached_at')) # Set if the IP's own cache entry answered
+            return
+    network, info = found
+    record.log_info.update({'cache_hit': True, 'network': network.with_prefixlen})
+    worker.update(record, '200', info)
+    print(f"WHOIS successful (network {network.with_prefixlen}) for {record.ip_or_domain} - {record.UploadFileName}---{record.TimeStamp}")
+
+def process(record, context):
+    if record.field != 'domain':
+        process_ip(record)
+        return
+    record.lookup = registrable_domain(record)
+    record.log_info['registrable_domain'] = record.lookup
+    with lock_for(record.lookup): # Rows of the same registrable domain wait for the first one's lookup
+        if record.lookup in results:
+            status, info = results[record.lookup]
+            worker.update(record, status, info)
+            print(f"WHOIS reused from {record.lookup} for {record.ip_or_domain} - {record.UploadFileName}---{record.TimeStamp}")
+            return
+        lookup(record)
+        results[record.lookup] = (record.outcome, record.info)
+
+def lookup(record):
+    UploadFileName = record.UploadFileName
+    TimeStamp = record.TimeStamp
+    ip_or_domain = record.ip_or_domain
+
+    txt_filename = slugify(ip_or_domain) + '_' + TimeStamp
+    
+    print(f"Starting WHOIS for {record.lookup}")
+    if worker.from_cache(record):
+        print(f"WHOIS successful (cached) for {ip_or_domain} - {UploadFileName}---{TimeStamp}")
+        return
+
+    if record.field == 'domain':
+        import whois # Heavy dependencies are imported on the path that uses them, keeping cold starts short
+        try:
+            with worker.limit('whois', record), record.stage('upstream'): # Registry WHOIS servers are only known once the lookup starts
+                w = whois.whois(record.lookup)
+            if w is None:
+                raise Exception("499")
+            elif w.domain_name is None:
+                raise Exception("400")
+            else:
+                body=serialize_datetimes(w) # Need to make dates JSON compatible for json.dumps() later
+        except Exception as e:
+            print(f"WHOIS failed for {ip_or_domain} - {UploadFileName}---{TimeStamp} \n {e}")
+            if "No match for" in str(e):
+                worker.update_error(record, "400")
+            else:
+                worker.update_error(record, e)
+            return
+    else:
+        import ipwhois
+        try:
+            with worker.limit('rdap', record), record.stage('upstream'):
                 w = ipwhois.IPWhois(ip_or_domain).lookup_rdap() 
-                if w is None:
-                    raise Exception("499")
-                elif w['network'] is None:
-                    raise Exception("400")
-                else:
-                    body=serialize_datetimes(w) # Need to make dates JSON compatible for json.dumps() later
-            except Exception as e:
-                print(f"WHOIS failed for {ip_or_domain} - {UploadFileName}---{TimeStamp} \n {e}")
-                log_info['duration'] = int(time.time() - current_time)
-                # if w is None: # In case its not caught in if statement nested in try (because exception was raised first)
-                #     update_error(UploadFileName, TimeStamp, "499", log_info)
-                update_error(UploadFileName, TimeStamp, e, log_info)
-                continue
-        else:
-            print(f"No IP or domain found for {UploadFileName}---{TimeStamp}")
-            continue
-
-        s3.put_object(
-            Bucket=s3_id,
-            Key=f'{UploadFileName}/whois/{txt_filename}.json',
-            Body=json.dumps(body),
-            ContentType='application/json'
-        )
-
-        if 'domain' in new_image:
-            log_info['duration'] = int(time.time() - current_time)
-            table.update_item(
-                Key={
-                    'UploadFileName': UploadFileName,
-                    'TimeStamp': TimeStamp
-                },
-                UpdateExpression="SET whois_status = :status, whois_info = :info",
-                ExpressionAttributeValues={
-                    ':status': '200',
-                    ':info': {
-                        'registrar': body.get('registrar', None),
-                        'name': body.get('name', None),
-                        'org': body.get('org', None),
-                        'creation_date': body.get('creation_date', None),
-                        'updated_date': body.get('updated_date', None),
-                        'whois_file_location': f'{s3_id}/{UploadFileName}/whois/{txt_filename}.json',
-                        'whois_log_info': log_info
-                    }
-                }
-            )
-        elif 'ip_address' in new_image:
-            log_info['duration'] = int(time.time() - current_time)
-            table.update_item(
-                Key={
-                    'UploadFileName': UploadFileName,
-                    'TimeStamp': TimeStamp
-                },
-                UpdateExpression="SET whois_status = :status, whois_info = :info",
-                ExpressionAttributeValues={
-                    ':status': '200',
-                    ':info': {
-                        'asn_registry': body.get('asn_registry', None),
-                        'asn': body.get('asn', None),
-                        'asn_cidr': body.get('asn_cidr', None),
-                        'asn_country_code': body.get('asn_country_code', None),
-                        'asn_date': body.get('asn_date', None),
-                        'asn_description': body.get('asn_description', None),
-                        'whois_file_location': f'{s3_id}/{UploadFileName}/whois/{txt_filename}.json',
-                        'whois_log_info': log_info
-                    }
-                }
-            )
-
-        print(f"WHOIS successful for {ip_or_domain} - {UploadFileName}---{TimeStamp}")
-
-    return {
-        'statusCode': 200,
-        'body': json.dumps("WHOIS SUCCESSFUL")
-    }
+            if w is None:
+                raise Exception("499")
+            elif w['network'] is None:
+                raise Exception("400")
+            else:
+                body=serialize_datetimes(w) # Need to make dates JSON compatible for json.dumps() later
+        except Exception as e:
+            print(f"WHOIS failed for {ip_or_domain} - {UploadFileName}---{TimeStamp} \n {e}")
+            # if w is None: # In case its not caught in if statement nested in try (because exception was raised first)
+            #     update_error(UploadFileName, TimeStamp, "499", log_info)
+            worker.update_error(record, e)
+            return
+
+    whois_file_location = worker.put_object(
+        record,
+        Key=f'{UploadFileName}/whois/{txt_filename}.json',
+        Body=json.dumps(body),
+        ContentType='application/json'
+    )
+
+    if record.field == 'domain':
+        info = {
+            'registrar': body.get('registrar', None),
+            'name': body.get('name', None),
+            'org': body.get('org', None),
+            'creation_date': body.get('creation_date', None),
+            'updated_date': body.get('updated_date', None),
+            'whois_file_location': whois_file_location
+        }
+    else:
+        info = {
+            'asn_registry': body.get('asn_registry', None),
+            'asn': body.get('asn', None),
+            'asn_cidr': body.get('asn_cidr', None),
+            'asn_country_code': body.get('asn_country_code', None),
+            'asn_date': body.get('asn_date', None),
+            'asn_description': body.get('asn_description', None),
+            'whois_file_location': whois_file_location
+        }
+
+    worker.update(record, '200', info)
+    worker.cache_put(record, '200', info)
 
+    print(f"WHOIS successful for {ip_or_domain} - {UploadFileName}---{TimeStamp}")
+
+def lambda_handler(event, context):
+    results.clear() # Later invocations reuse results through the cache table, for as long as CACHE_TTL_WHOIS
+    locks.clear()
+    response = worker.run(event, context, process, prepare)
+    rdap_index.report()
+    return response
@@ -0,0 +1,306 @@
+import json
+import time
+import datetime
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from boto3.dynamodb.types import TypeSerializer
+import aws
+import cache
+import indicator
+import metrics
+import packed
+
+db_id = os.environ['DB_ID']
+concurrency = int(os.environ.get('CONCURRENCY', '1')) # Records of a batch processed at once
+margin_ms = int(os.environ.get('DEADLINE_MARGIN_MS', '10000')) # Time kept free before the Lambda timeout for the final writes
+host_concurrency = json.loads(os.environ.get('HOST_CONCURRENCY', '{}')) # e.g. {"crt.sh": 1, "*": 2}. "*" applies to hosts not listed. Unlisted hosts are unlimited without it.
+
+serializer = TypeSerializer() # Rows are written through the low-level client, which unlike the Table resource is thread safe
+
+def queue_url(event_source_arn):
+    """ arn:aws:sqs:region:account:name -> https://sqs.region.amazonaws.com/account/name """
+    region, account, name = event_source_arn.split(':')[3:6]
+    return f"https://sqs.{region}.amazonaws.com/{account}/{name}"
+
+def release(records):
+    """ Makes deferred messages visible again straight away, instead of after the queue's visibility timeout """
+    queues = {}
+    for sqs_record in records: # Batches from the VT scheduler mix messages from several queues
+        queues.setdefault(sqs_record['eventSourceARN'], []).append(sqs_record)
+    batches = [queue_records[i:i + 10] for queue_records in queues.values() for i in range(0, len(queue_records), 10)] # Maximum of 10 entries per call
+    for batch in batches:
+        try:
+            response = aws.client('sqs').change_message_visibility_batch(
+                QueueUrl=queue_url(batch[0]['eventSourceARN']),
+                Entries=[
+                    {'Id': str(j), 'ReceiptHandle': sqs_record['receiptHandle'], 'VisibilityTimeout': 0}
+                    for j, sqs_record in enumerate(batch)
+                ]
+            )
+            for failed in response.get('Failed', []):
+                print(f"Error releasing message {batch[int(failed['Id'])]['messageId']}: {failed.get('Message')}")
+        except Exception as e: # Messages still come back after the visibility timeout
+            print("Error releasing messages:", e)
+
+def trace_context(payload, sqs_record):
+    """ Hop timestamps (ms) carried from ingest in the message body, plus SNS fan-out, SQS send and first receive """
+    try:
+        trace = dict(json.loads(payload.get('Message') or '{}').get('trace') or {})
+    except (ValueError, AttributeError): # Messages published before the trace context was added hold plain text
+        trace = {}
+    try: # SNS delivery time, e.g. 2024-01-01T00:00:00.000Z
+        fanout = datetime.datetime.strptime(payload['Timestamp'], '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=datetime.timezone.utc)
+        trace['fanout'] = int(fanout.timestamp() * 1000)
+    except (KeyError, TypeError, ValueError):
+        pass
+    attributes = sqs_record.get('attributes') or {}
+    if 'SentTimestamp' in attributes:
+        trace['sent'] = int(attributes['SentTimestamp'])
+    if 'ApproximateFirstReceiveTimestamp' in attributes:
+        trace['received'] = int(attributes['ApproximateFirstReceiveTimestamp'])
+    return trace
+
+def to_attribute_values(values):
+    return {name: serializer.serialize(value) for name, value in values.items()}
+
+class StopBatch(Exception):
+    """ Raised by a handler to stop processing. The current record and the rest of the batch are returned to the queue. """
+
+class Record:
+    """ One row delivered from the SNS fan-out through SQS """
+    def __init__(self, sqs_record, fields=indicator.default_columns):
+        self.message_id = sqs_record['messageId']
+        self.payload = json.loads(sqs_record['body']) # SNS envelope
+        self.attributes = self.payload.get('MessageAttributes') or {}
+        self.UploadFileName = self.attributes['UploadFileName']['Value']
+        self.TimeStamp = self.attributes['TimeStamp']['Value']
+        self.field = next((field for field in fields if field in self.attributes), None) # Column the indicator was read from
+        self.ip_or_domain = self.attributes[self.field]['Value'] if self.field else None
+        self.lookup = self.ip_or_domain # What the upstream is asked about and the result is cached under. Handlers may narrow it, e.g. to the registrable domain.
+        self.indicator_type = indicator.classify(self.ip_or_domain) if self.field else None
+        self.log_info = {}
+        self.trace = trace_context(self.payload, sqs_record)
+        self.start_time = time.time()
+        self.timer = metrics.Timer()
+        self.outcome = 'none' # Last status written, reported (as metrics.outcome_of) in the metrics' outcome dimension
+        self.info = None # Info written with that status
+        self.prepared = None # Set by the handler's prepare hook, for lookups done for the whole batch at once
+
+    def stage(self, name):
+        """ Times a block as one stage of this record, e.g. with record.stage('upstream'): ... """
+        return self.timer.stage(name)
+
+    @property
+    def key(self):
+        return {
+            'UploadFileName': self.UploadFileName,
+            'TimeStamp': self.TimeStamp
+        }
+
+class Worker:
+    """ Common SQS handling for the enrichment modules: record parsing, status writes and partial batch failure reporting """
+    def __init__(self, module, info_attr=None, log_key=None, record_seconds=5):
+        self.module = module
+        self.fields = indicator.module_columns(module) # Order in which indicator columns are looked up, for rows that have both. sns.py routes by the same order.
+        self.status_attr = f"{module}_status"
+        self.info_attr = info_attr or f"{module}_info"
+        self.log_key = log_key or f"{module}_log_info"
+        self.semaphores = {} # Host -> [semaphore, records holding or waiting for it]
+        self.semaphores_lock = threading.Lock()
+        self.packer = None # Set for each invocation when PACKED_OUTPUT is on
+        self.record_ms = int(os.environ.get('RECORD_SECONDS', record_seconds)) * 1000 # Estimated time per record, updated as records finish
+        self.record_ms_lock = threading.Lock()
+
+    def has_time(self, context):
+        """ Whether another record can finish before the Lambda timeout """
+        return context.get_remaining_time_in_millis() > self.record_ms + margin_ms
+
+    def observe(self, record):
+        """ Moving average of record durations, so the estimate follows the upstream's current latency """
+        elapsed_ms = (time.time() - record.start_time) * 1000
+        with self.record_ms_lock:
+            self.record_ms = 0.8 * self.record_ms + 0.2 * elapsed_ms
+
+    @contextmanager
+    def limit(self, host, record=None):
+        """ Caps the number of records calling the same upstream host at once, as set in HOST_CONCURRENCY.
+        Time spent waiting for a slot is counted as the record's wait stage. """
+        host_limit = host_concurrency.get(host, host_concurrency.get('*'))
+        if host_limit is None:
+            yield
+            return
+        with self.semaphores_lock:
+            if host not in self.semaphores:
+                self.semaphores[host] = [threading.BoundedSemaphore(int(host_limit)), 0]
+            entry = self.semaphores[host]
+            entry[1] += 1 # Records holding or waiting for a slot
+        try:
+            start = time.perf_counter()
+            with entry[0]:
+                if record is not None:
+                    record.timer.add('wait', (time.perf_counter() - start) * 1000)
+                yield
+        finally:
+            with self.semaphores_lock:
+                entry[1] -= 1
+                if entry[1] == 0: # Hosts nobody is calling are dropped, so warm containers do not keep one per website ever seen
+                    del self.semaphores[host]
+
+    def update(self, record, status, info=None, extra=None, info_attr=None):
+        """ Writes the module's status and info (with log info and duration) to the row in one update.
+        If status is None, only info is written. extra holds any other attributes to set in the same update.
+        info_attr overrides the attribute info is written to. """
+        end_time = time.time()
+        record.log_info['duration'] = int(end_time - record.start_time)
+        record.log_info['duration_ms'] = int((end_time - record.start_time) * 1000)
+        record.log_info['trace'] = {**record.trace, 'start': int(record.start_time * 1000), 'end': int(end_time * 1000)} # Read by tools/trace_report.py
+        assignments = [f"{info_attr or self.info_attr} = :info"]
+        values = {':info': {**(info or {}), self.log_key: record.log_info}}
+        if status is not None:
+            assignments.insert(0, f"{self.status_attr} = :status")
+            values[':status'] = str(status)
+            record.outcome = str(status)
+            record.info = info
+        for i, (name, value) in enumerate((extra or {}).items()):
+            assignments.append(f"{name} = :extra{i}")
+            values[f":extra{i}"] = value
+        with record.stage('dynamodb'):
+            aws.client('dynamodb').update_item(
+                TableName=db_id,
+                Key=to_attribute_values(record.key),
+                UpdateExpression="SET " + ", ".join(assignments),
+                ExpressionAttributeValues=to_attribute_values(values)
+            )
+
+    def put_object(self, record, Key, Body, ContentType=None):
+        """ Stores a result in the S3 bucket, or in the upload's segment in packed mode. Returns its file location. """
+        with record.stage('s3'):
+            if self.packer is not None:
+                return self.packer.put(record, Key, Body, ContentType)
+            request = {'Bucket': packed.s3_id, 'Key': Key, 'Body': Body}
+            if ContentType:
+                request['ContentType'] = ContentType
+            aws.client('s3').put_object(**request)
+            return packed.location(packed.s3_id, Key)
+
+    def upload_fileobj(self, record, Key, Fileobj, ContentType=None):
+        """ Like put_object, but streams Fileobj to S3 as it is read instead of holding it in memory first.
+        In packed mode it is read whole, as segments are written from memory anyway. """
+        with record.stage('s3'):
+            if self.packer is not None:
+                return self.packer.put(record, Key, Fileobj.read(), ContentType)
+            extra_args = {'ContentType': ContentType} if ContentType else None
+            aws.client('s3').upload_fileobj(Fileobj, packed.s3_id, Key, ExtraArgs=extra_args)
+            return packed.location(packed.s3_id, Key)
+
+    def update_error(self, record, e):
+        self.update(record, str(e))
+
+    def from_cache(self, record):
+        """ Copies a fresh cached result into the row. Returns True if the upstream call can be skipped. """
+        with record.stage('cache'):
+            item = cache.get(self.module, record.lookup)
+        if item is None:
+            return False
+        record.log_info.update({'cache_hit': True, 'cached_at': item['CachedAt']})
+        self.update(record, item['Status'], item['Info'])
+        return True
+
+    def cache_put(self, record, status, info):
+        """ Stores the record's result for other uploads to reuse """
+        with record.stage('cache'):
+            cache.put(self.module, record.lookup, status, info)
+
+    def emit(self, record, outcome=None):
+        record.timer.add('total', (time.time() - record.start_time) * 1000)
+        if outcome is None:
+            outcome = 'cached' if record.log_info.get('cache_hit') else metrics.outcome_of(record.outcome)
+        metrics.emit(self.module, outcome, record.timer.stages)
+
+    def parse(self, sqs_record):
+        """ Returns the message as a Record, or None if it should be dropped """
+        try:
+            record = Record(sqs_record, self.fields)
+        except Exception as e: # Malformed messages would fail again, so they are dropped
+            print(f"Unreadable message dropped: {sqs_record.get('messageId')} \n {e}")
+            return None
+        if record.ip_or_domain is None:
+            print(f"No IP or domain found for {record.UploadFileName}---{record.TimeStamp}")
+            return None
+        return record
+
+    def run(self, event, context, process, prepare=None):
+        """ Calls process(record, context) for each record, up to CONCURRENCY records at once.
+        Only records that raise are reported back to SQS for retry. If given, prepare(records, context) is called once
+        with every record of the batch first, so lookups can be made for the whole batch together. """
+        base_log_info = {
+            'log_stream_name': context.log_stream_name,
+            'log_group_name': context.log_group_name,
+            'aws_request_id': context.aws_request_id
+        }
+        self.packer = packed.Packer(self.module, context.aws_request_id) if packed.enabled else None
+        stopped = threading.Event() # Set once a record raises StopBatch. Records not yet started are returned to the queue.
+        deferred = [] # Records not started because the invocation would time out first
+
+        prepared = {}
+        if prepare is not None:
+            prepared = {sqs_record['messageId']: self.parse(sqs_record) for sqs_record in event['Records']}
+            records = [record for record in prepared.values() if record is not None]
+            try:
+                if records:
+                    prepare(records, context) # Records keep their start time, so the batch lookups count towards each
+            except Exception as e: # Records left without prepared results fail in process and are retried
+                print(f"{self.module} batch preparation failed \n {e}")
+
+        def handle(sqs_record):
+            """ Returns the record's messageId if it should be retried, otherwise None """
+            if stopped.is_set():
+                return sqs_record['messageId']
+            if not self.has_time(context):
+                deferred.append(sqs_record)
+                return sqs_record['messageId']
+            record = prepared[sqs_record['messageId']] if prepare is not None else self.parse(sqs_record)
+            if record is None:
+                return None
+            record.log_info = dict(base_log_info)
+            try:
+                process(record, context)
+                self.observe(record)
+            except StopBatch as e:
+                if not stopped.is_set():
+                    print(f"Stopping batch, unstarted messages returned to queue: {e}")
+                stopped.set()
+                self.emit(record, 'stopped')
+                return record.message_id
+            except Exception as e:
+                print(f"{self.module} failed, message returned to queue: {record.ip_or_domain} - {record.UploadFileName}---{record.TimeStamp} \n {e}")
+                self.emit(record, 'error')
+                return record.message_id
+            self.emit(record)
+            return None
+
+        records = event['Records']
+        if concurrency > 1 and len(records) > 1:
+            with ThreadPoolExecutor(max_workers=min(concurrency, len(records))) as executor:
+                retry = list(executor.map(handle, records))
+        else:
+            retry = [handle(sqs_record) for sqs_record in records]
+        retry = [message_id for message_id in retry if message_id]
+        if deferred:
+            print(f"{len(deferred)} messages returned to queue before the Lambda timeout (estimated {int(self.record_ms)} ms per record)")
+            release(deferred)
+
+        if self.packer is not None: # Rows already point at the segment, so their messages are retried if it was not written
+            for record in self.packer.flush():
+                cache.delete(self.module, record.lookup)
+                if record.message_id not in retry:
+                    retry.append(record.message_id)
+            self.packer = None
+        failures = [{'itemIdentifier': message_id} for message_id in retry]
+
+        cache.report(self.module)
+        return {
+            'batchItemFailures': failures
+        }
@@ -0,0 +1,96 @@
+""" Latency waterfall for one upload, from the trace context the modules write to their log info.
+
+Every row carries a TraceId and the time csv_code stored it. sns.py adds when the DynamoDB stream saw the row and when
+it was published, and each module adds when SNS delivered it, when SQS received it, and when processing started and
+ended. For each module this prints the median and p95 of every hop and a waterfall of queue wait (.) and processing (#),
+measured from the upload's first ingested row.
+
+Usage: python tools/trace_report.py <UploadFileName> [--table DB_ID] [--region ap-southeast-1]
+"""
+import argparse
+import os
+import boto3
+
+modules = { # Module -> (info attribute, log info key), as set by each Worker
+    'vt': ('vt_info', 'vt_log_info'),
+    'dns': ('dns_info', 'dns_log_info'),
+    'whois': ('whois_info', 'whois_log_info'),
+    'html': ('html_info', 'html_log_info'),
+    'cert': ('cert_info', 'cert_log_info'),
+    'hist': ('archived_page_info', 'hist_log_info')
+}
+
+hops = [ # Name, from, to
+    ('ingest', 'ingested', 'stream'), # Row stored until the stream record was created
+    ('stream', 'stream', 'published'), # Stream record until sns.py published it
+    ('fanout', 'published', 'sent'), # SNS delivery to the module's queue
+    ('queue', 'sent', 'start'), # Waiting in SQS, including retries and deferrals
+    ('process', 'start', 'end') # Module processing, up to its final write
+]
+
+width = 50 # Characters in the waterfall
+
+def read_traces(table, upload):
+    """ Returns module -> list of traces for every row of the upload """
+    traces = {module: [] for module in modules}
+    request = {
+        'KeyConditionExpression': 'UploadFileName = :upload',
+        'ExpressionAttributeValues': {':upload': upload}
+    }
+    while True:
+        response = table.query(**request)
+        for item in response['Items']:
+            for module, (info_attr, log_key) in modules.items():
+                trace = (item.get(info_attr) or {}).get(log_key, {}).get('trace')
+                if trace and 'ingested' in trace: # Rows ingested before tracing was added only have the module's hops
+                    traces[module].append({hop: int(value) for hop, value in trace.items() if hop != 'id'})
+        if 'LastEvaluatedKey' not in response:
+            return traces
+        request['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def report(traces):
+    origin = min((trace['ingested'] for module in traces.values() for trace in module), default=None)
+    if origin is None:
+        print("No traced rows found. Rows ingested before tracing was added have no trace context.")
+        return
+    finished = max(trace['end'] for module in traces.values() for trace in module)
+    print(f"{'module':<7} {'rows':>5}  " + "  ".join(f"{name + ' p50/p95 ms':>22}" for name, _, _ in hops))
+    waterfall = []
+    for module, module_traces in traces.items():
+        if not module_traces:
+            continue
+        columns = []
+        for name, start, end in hops:
+            durations = [trace[end] - trace[start] for trace in module_traces if start in trace and end in trace]
+            columns.append(f"{percentile(durations, 0.5):>10} / {percentile(durations, 0.95):>9}" if durations else f"{'-':>22}")
+        print(f"{module:<7} {len(module_traces):>5}  " + "  ".join(columns))
+        sent = min(trace.get('sent', trace['start']) for trace in module_traces) - origin
+        start = percentile([trace['start'] for trace in module_traces], 0.5) - origin
+        end = max(trace['end'] for trace in module_traces) - origin
+        waterfall.append((module, sent, start, end))
+
+    total = max(finished - origin, 1)
+    print(f"\nWaterfall from first ingested row to last module finish ({total / 1000:.1f} s): . queued (first sent to median start), # processing (median start to last end)")
+    for module, sent, start, end in waterfall:
+        columns = [min(max(int(value * width / total), 0), width) for value in (sent, start, end)]
+        bar = ' ' * columns[0] + '.' * (columns[1] - columns[0]) + '#' * max(columns[2] - columns[1], 1)
+        print(f"{module:<7} |{bar:<{width + 1}}| {end / 1000:.1f} s")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('upload', help="UploadFileName of the rows, i.e. the S3 key without upload/")
+    parser.add_argument('--table', default=os.environ.get('DB_ID'), help="DynamoDB table (default: $DB_ID)")
+    parser.add_argument('--region', default=None, help="AWS region (default: from the AWS configuration)")
+    args = parser.parse_args()
+    if not args.table:
+        parser.error("--table or DB_ID is required")
+
+    table = boto3.resource('dynamodb', region_name=args.region).Table(args.table)
+    report(read_traces(table, args.upload))
+
+if __name__ == '__main__':
+    main()